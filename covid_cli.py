@@ -0,0 +1,96 @@
+import argparse
+import io
+import os
+import sys
+import time
+# only light modules are imported here: Pillow, numpy, the fonts and the graph scripts are loaded by the commands
+# that render something, so that listing the regions starts fast
+from covid_regions import match_regions
+from covid_store import ColumnStore, store_is_fresh, write_store
+
+
+def list_regions(args):
+    """Prints the regions of the last snapshot of the data file, without downloading it
+
+    The columnar store is converted from the snapshot first if it is missing or was converted from another file.
+    """
+    source_path = args.offline or args.cache_path
+    if not os.path.exists(source_path):
+        sys.exit("No snapshot of the data file found (" + source_path + "), run the render command or "
+                 "covid_download.py first")
+    if not store_is_fresh(args.store, source_path):
+        import covid_deaths_graph as graph
+        from covid_download import open_snapshot
+        parse = graph.iter_countries_csv if ".csv" in source_path else graph.iter_countries
+        with open_snapshot(source_path) as data_file:
+            write_store(args.store, parse(io.TextIOWrapper(data_file, encoding="utf-8", newline="")), source_path)
+
+    with ColumnStore(args.store) as store:
+        for code in match_regions(store.regions, args.patterns or ["*"]):
+            location, _, nb_days = store.regions[code]
+            if location is None:
+                # kept as it is by write_store, its days cannot be read
+                print(code + "\t(invalid data)")
+                continue
+            print(code + "\t" + location + "\t" + str(nb_days))
+
+
+def render(args):
+    import covid_deaths_graph as graph
+    graph.main(args.patterns, args.offline)
+    print("-- Execution time: %s seconds --" % (time.time() - graph.start_time))
+
+
+def render_france(args):
+    import covid_deaths_graph_fra as graph_fra
+    graph_fra.main(args.offline)
+    print("-- Temps d'exécution : %s secondes --" % (time.time() - graph_fra.start_time))
+
+
+def bench(args):
+    import covid_deaths_graph_bench as graph_bench
+    graph_bench.main(args.bench_args)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Lists the regions of the data file and renders their graphs. The "
+                                                 "other settings are the ones at the top of the main functions of "
+                                                 "the scripts")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    list_parser = commands.add_parser("list", help="list the regions of the last snapshot, without downloading it")
+    list_parser.add_argument("patterns", nargs="*", metavar="PATTERN",
+                             help="region codes or glob patterns, e.g. FRA or 'OWID_*' (default: all the regions)")
+    list_parser.add_argument("--offline", metavar="PATH", help="local copy of the data file read instead of the cache")
+    list_parser.add_argument("--cache-path", default="owid-covid-data.json.gz",
+                             help="compressed copy of the last download (default: owid-covid-data.json.gz)")
+    list_parser.add_argument("--store", default="owid-covid-data.store",
+                             help="columnar copy of the data file (default: owid-covid-data.store)")
+    list_parser.set_defaults(function=list_regions)
+
+    render_parser = commands.add_parser("render", help="render the graphs of the regions that match")
+    render_parser.add_argument("patterns", nargs="+", metavar="PATTERN",
+                               help="region codes or glob patterns, e.g. FRA or 'OWID_*', '*' for all the regions")
+    render_parser.add_argument("--offline", metavar="PATH", help="local copy of the data file, without network access")
+    render_parser.set_defaults(function=render)
+
+    france_parser = commands.add_parser("france", help="render the graph of the data.gouv.fr figures for France")
+    france_parser.add_argument("--offline", metavar="PATH", help="local copy of the data file, without network access")
+    france_parser.set_defaults(function=render_france)
+
+    bench_parser = commands.add_parser("bench", help="run the benchmarks, see covid_deaths_graph_bench.py --help",
+                                       add_help=False)
+    bench_parser.add_argument("bench_args", nargs=argparse.REMAINDER)
+    bench_parser.set_defaults(function=bench)
+
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["bench"]:
+        # the arguments after the command are the ones of the benchmark script, --help included
+        args = argparse.Namespace(function=bench, bench_args=argv[1:])
+    else:
+        args = parser.parse_args(argv)
+    args.function(args)
+
+
+if __name__ == '__main__':
+    main()
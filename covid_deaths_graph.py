@@ -1,123 +1,287 @@
-import urllib.request
+import collections
+import concurrent.futures
+import html
+import functools
+import io
 from urllib.error import URLError, HTTPError
+import cProfile
+import csv
+import hashlib
+import itertools
 import json
+import math
+import multiprocessing
+import operator
+import os
+import queue
 import random
+import signal
+import threading
+import traceback
+import types
 from PIL import Image, ImageDraw, ImageFont
 import time
 from sys import exit
+from covid_download import open_data, stream_data
+from covid_labels import draw_label, text_size
+from covid_metrics import timed_iter, write_metrics
+from covid_palette import BLACK, PALETTE, WHITE, new_canvas, pixel_value
+from covid_png import ApngWriter, PngWriter, replace_if_changed, write_if_changed
+from covid_regions import is_glob, match_regions
+from covid_schedule import CostScheduler, predict_cost, print_cost_report
+from covid_series import DaySeries, region_seed
+from covid_smoothing import smooth_batch
+from covid_store import ColumnStore, store_is_fresh, write_store
+from covid_victims import band_capacity, place_band_victims, victim_scale
+
+try:
+    import numpy as np
+except ImportError:
+    # numpy is optional: without it, victims are placed one by one with the slower pure Python loop
+    np = None
 
 start_time = time.time()
-font_regular = ImageFont.truetype("asap.ttf", size=10)
-font_small = ImageFont.truetype("asap.ttf", size=8)
+# columns of the Our World in Data CSV file read by iter_countries_csv, all the others are skipped
+CSV_COLUMNS = ["iso_code", "location", "date", "new_deaths", "total_deaths"]
 
 
-def calc_moving_average(data, n):
-    """Calculates the average of the last n values in the data dictionary
+@functools.lru_cache(maxsize=None)
+def load_fonts():
+    """Loads the fonts on the first call only, so that importing the script without rendering anything stays fast
 
-    :param data: dictionary
-    :param n: number of days used to calculate the moving average
-    :return: integer value of the average
+    :return: tuple (regular font, small font)
     """
-    past_n_days = data[-n:]
-    sum_values = 0
-    for day in past_n_days:
-        sum_values += day["daily_deaths"]
-    n_moving_average = int(sum_values / n)
-    return n_moving_average
+    return ImageFont.truetype("asap.ttf", size=10), ImageFont.truetype("asap.ttf", size=8)
 
 
-def print_ten_thousand_text(draw, total_deaths, date, line_y, text_left):
+def print_ten_thousand_text(img, total_deaths, date, line_y, text_left):
     """Draws a line every 10000 deaths, the date and the total exact number of deaths at this date
 
-    :param draw: ImageDraw object that will be the final output image
+    :param img: Image object that will be the final output image
     :param total_deaths: integer
     :param date: date with format yyyy-mm-dd
     :param line_y: y coordinate of the line that is drawn
     :param text_left: x coordinate from which the text must be drawn
     :return: n/a
     """
+    font_regular, font_small = load_fonts()
     line_y -= 2
     ten_thousand_text_date = date
     ten_thousand_text_deaths = str(int(total_deaths))
-    ten_thousand_text_date_width, ten_thousand_text_date_height = draw.textsize(ten_thousand_text_date,
-                                                                                font=font_small)
-    ten_thousand_text_deaths_width, ten_thousand_text_deaths_height = draw.textsize(ten_thousand_text_deaths,
-                                                                                    font=font_regular)
-    draw.text((text_left, line_y - ten_thousand_text_date_height),
-              ten_thousand_text_date,
-              font=font_small,
-              fill=(255, 0, 0))
-    draw.text((text_left, line_y + 2),
-              ten_thousand_text_deaths + " deaths",
-              font=font_regular,
-              fill=(255, 0, 0))
-
-
-def print_new_year(draw, year, line_y, year_left):
+    ten_thousand_text_date_width, ten_thousand_text_date_height = text_size(ten_thousand_text_date, font_small)
+    ten_thousand_text_deaths_width, ten_thousand_text_deaths_height = text_size(ten_thousand_text_deaths, font_regular)
+    draw_label(img, (text_left, line_y - ten_thousand_text_date_height),
+               ten_thousand_text_date,
+               font_small,
+               (255, 0, 0))
+    draw_label(img, (text_left, line_y + 2),
+               ten_thousand_text_deaths + " deaths",
+               font_regular,
+               (255, 0, 0))
+
+
+def print_new_year(img, year, line_y, year_left):
     """Draws a line when a new year is beginning and writes the years
 
-    :param draw: ImageDraw object that will be the final output image
+    :param img: Image object that will be the final output image
     :param year: year that is ending
     :param line_y: y coordinate of the line that is drawn
     :param year_left: x coordinate from which the text with the year must be drawn
     :return: n/a
     """
+    font_regular, _ = load_fonts()
     line_y -= 1
     new_year = year + 1
-    year_width, year_height = draw.textsize(str(year), font=font_regular)
-    draw.text((year_left, line_y - year_height),
-              str(year),
-              font=font_regular,
-              fill=(0, 0, 255))
-    draw.text((year_left, line_y),
-              str(new_year),
-              font=font_regular,
-              fill=(0, 0, 255))
-
-
-def generate_image(data, location, region):
-    """Generates the image output from the data collected
+    year_width, year_height = text_size(str(year), font_regular)
+    draw_label(img, (year_left, line_y - year_height),
+               str(year),
+               font_regular,
+               (0, 0, 255))
+    draw_label(img, (year_left, line_y),
+               str(new_year),
+               font_regular,
+               (0, 0, 255))
 
-    :param data: dictionary that contains all data, formatted and ready to be used to draw the image output
-    :param location: name of the country or region
-    :param region: code of the country or region
+
+def place_victims(data, plot_width, line_multiplier, scale=1, seed=None):
+    """Places the victims of every day in a boolean array, with one batched random sample per day band
+
+    Each band covers line_multiplier + 1 rows, like the pure Python loop, so consecutive bands share a row and
+    a cell already used by the previous day is never picked twice.
+
+    :param data: DaySeries that contains all data, formatted and ready to be used to draw the image output
+    :param plot_width: width in pixels of the area where victims are drawn
+    :param line_multiplier: height in pixels of each day
+    :param scale: number of victims per pixel, see victim_scale
+    :param seed: seed of the random placement, see region_seed. None for a different placement at each call
+    :return: 2D boolean numpy array, True where a victim is drawn
+    """
+    victims = np.zeros((len(data) * line_multiplier + 1, plot_width), dtype=bool)
+    rng = np.random.default_rng(seed)
+
+    for day_increment, moving_average in enumerate(data.moving_average):
+        # a slice of whole rows is contiguous, so ravel() returns a view and the band is filled in place
+        band = victims[day_increment * line_multiplier:(day_increment + 1) * line_multiplier + 1].ravel()
+        fill_band(band, math.ceil(moving_average / scale), rng)
+
+    return victims
+
+
+def fill_band(band, nb_victims, rng):
+    """Sets nb_victims cells of a band that are still free, chosen at random in a single batch
+
+    :param band: flat boolean numpy array of the cells of a band, True where a victim is already drawn
+    :param nb_victims: number of victims to place
+    :param rng: numpy random Generator
     :return: n/a
     """
+    if nb_victims <= 0:
+        return
+    free_cells = np.flatnonzero(~band)
+    chosen = rng.choice(free_cells, size=min(nb_victims, free_cells.size), replace=False)
+    band[chosen] = True
+
+
+def iter_victim_rows(data, plot_width, line_multiplier, scale=1, seed=None):
+    """Places the victims band by band like place_victims, yielding the rows of the plot one at a time
+
+    Only the band being placed is kept in memory. The rows yielded are views of this band, they must be copied
+    before the next one is requested.
+
+    :param data: DaySeries that contains all data, formatted and ready to be used to draw the image output
+    :param plot_width: width in pixels of the area where victims are drawn
+    :param line_multiplier: height in pixels of each day
+    :param scale: number of victims per pixel, see victim_scale
+    :param seed: seed of the random placement, see region_seed. The victims are placed exactly as place_victims
+    places them with the same seed
+    :return: generator of the len(data) * line_multiplier + 1 rows of the plot, as boolean numpy arrays
+    """
+    band = np.zeros((line_multiplier + 1, plot_width), dtype=bool)
+    rng = np.random.default_rng(seed)
+
+    for moving_average in data.moving_average:
+        # the last row of the previous band is the first row of this one
+        band[0] = band[line_multiplier]
+        band[1:] = False
+        fill_band(band.ravel(), math.ceil(moving_average / scale), rng)
+        for row in band[:line_multiplier]:
+            yield row
+
+    yield band[line_multiplier]
+
+
+def image_path(region, suffix=""):
+    """Returns the path of the image of a region
+
+    :param region: code of the country or region
+    :param suffix: text added after the region code, e.g. "_poster"
+    :return: file name of the PNG image
+    """
+    return 'covid_' + region.lower() + suffix + '.png'
+
+
+def layout_image(data, line_multiplier=None):
+    """Calculates the size of the image and the position of its elements
+
+    :param data: DaySeries that contains all data, formatted and ready to be used to draw the image output
+    :param line_multiplier: height in pixels of each day, None to choose it so that the image is at most 1900 pixels
+    wide and 1.5 times higher than wide
+    :return: SimpleNamespace with the layout variables
+    """
     # Variables used to set the layout. Small changes are generally fine.
     nb_days = len(data)
     margin = 15
-    max_moving_average = max(item['moving_average'] for item in data) + 1
+    max_moving_average = max(data.moving_average) + 1
     margin_top = 60
     margin_bottom = 30
     margin_right = 7 * margin
-    line_multiplier = 1
     day_line_length = 3
     day_line_margin = 2
     ten_thousand_deaths_length = 3 * margin
 
-    img_width = 2000
-    img_height = 1
-    while img_width > 1900 or img_width * 1.5 > img_height:
-        line_multiplier += 1
-        img_width = max(round(max_moving_average / line_multiplier) + 2 * margin + margin_right, 500)
+    if line_multiplier is None:
+        line_multiplier = 1
+        img_width = 2000
+        img_height = 1
+        while img_width > 1900 or img_width * 1.5 > img_height:
+            line_multiplier += 1
+            # rounded up so that the band of the busiest day can hold all its victims
+            img_width = max(math.ceil(max_moving_average / line_multiplier) + 2 * margin + margin_right, 500)
+            img_height = line_multiplier * nb_days + margin_top + margin_bottom + 2 * margin
+    else:
+        img_width = max(math.ceil(max_moving_average / line_multiplier) + 2 * margin + margin_right, 500)
         img_height = line_multiplier * nb_days + margin_top + margin_bottom + 2 * margin
     text_left = img_width - margin_right
-    img = Image.new(mode="RGB", size=(img_width, img_height), color=(255, 255, 255))
-    draw = ImageDraw.Draw(img)
+
+    # a day that does not fit in its band would make the whole graph use several victims per pixel
+    plot_width = img_width - 2 * margin - margin_right
+    scale = victim_scale(max(data.moving_average), band_capacity(plot_width, line_multiplier))
+
+    # show major lines depending on the total number of deaths
+    if data.total_deaths[-1] > 1000000:
+        multiplier = 500000
+    elif data.total_deaths[-1] > 200000:
+        multiplier = 100000
+    elif data.total_deaths[-1] > 20000:
+        multiplier = 10000
+    elif data.total_deaths[-1] > 2000:
+        multiplier = 1000
+    elif data.total_deaths[-1] > 500:
+        multiplier = 250
+    elif data.total_deaths[-1] > 100:
+        multiplier = 50
+    elif data.total_deaths[-1] > 50:
+        multiplier = 20
+    else:
+        multiplier = 10
+
+    return types.SimpleNamespace(nb_days=nb_days, margin=margin, margin_top=margin_top, margin_bottom=margin_bottom,
+                                 margin_right=margin_right, line_multiplier=line_multiplier,
+                                 day_line_length=day_line_length, day_line_margin=day_line_margin,
+                                 ten_thousand_deaths_length=ten_thousand_deaths_length, img_width=img_width,
+                                 img_height=img_height, text_left=text_left, plot_width=plot_width, scale=scale,
+                                 multiplier=multiplier)
+
+
+def draw_frame(img, data, location, layout, offset_y=0):
+    """Draws the titles, the legend and the footer of the image
+
+    :param img: Image object that will be the final output image, or a horizontal strip of it
+    :param data: DaySeries that contains all data, formatted and ready to be used to draw the image output
+    :param location: name of the country or region
+    :param layout: SimpleNamespace returned by layout_image
+    :param offset_y: y coordinate of the top of the strip in the final image
+    :return: n/a
+    """
+    font_regular, _ = load_fonts()
+    margin = layout.margin
+    margin_top = layout.margin_top
+    margin_bottom = layout.margin_bottom
+    margin_right = layout.margin_right
+    img_width = layout.img_width
+    img_height = layout.img_height - offset_y
 
     # Main title of the graph
-    title = "DEATHS FROM COVID-19 IN " + location.upper() + " FROM " + data[0]['date'] + " TO " + data[-1]['date']
-    title2 = "TOTAL: " + str(int(data[-1]["total_deaths"])) + " VICTIMS"
-    title_width, title_height = draw.textsize(title, font=font_regular)
-    title2_width, title2_height = draw.textsize(title2, font=font_regular)
+    title = "DEATHS FROM COVID-19 IN " + location.upper() + " FROM " + data.date(0) + " TO " + data.date(-1)
+    title2 = "TOTAL: " + str(int(data.total_deaths[-1])) + " VICTIMS"
+    title_width, title_height = text_size(title, font_regular)
+    title2_width, title2_height = text_size(title2, font_regular)
 
     # Subtitle to give secondary information
-    sub_title_1 = "1 black pixel = 1 victim"
-    sub_title_1_width, sub_title_1_height = draw.textsize(sub_title_1, font=font_regular)
-    sub_title_2 = "Deaths smoothed over 7 days"
+    if layout.scale == 1:
+        sub_title_1 = "1 black pixel = 1 victim"
+    else:
+        sub_title_1 = "1 black pixel = " + str(layout.scale) + " victims"
+    sub_title_1_width, sub_title_1_height = text_size(sub_title_1, font_regular)
+    if data.smoothing == "centered":
+        sub_title_2 = "Deaths smoothed over " + str(data.window) + " days, centered"
+    elif data.smoothing == "exponential":
+        sub_title_2 = "Deaths smoothed exponentially over " + str(data.window) + " days"
+    else:
+        sub_title_2 = "Deaths smoothed over " + str(data.window) + " days"
 
     days = "Days"
-    days_width, days_height = draw.textsize(days, font=font_regular)
+    days_width, days_height = text_size(days, font_regular)
 
     # Footer for credit information.
     footer_1 = "David Bertho"
@@ -125,153 +289,761 @@ def generate_image(data, location, region):
     source_1 = "Source : Our World in Data"
     source_2 = "ourworldindata.org/covid-deaths"
 
-    footer_1_width, footer_1_height = draw.textsize(footer_1, font=font_regular)
-    footer_2_width, footer_2_height = draw.textsize(footer_2, font=font_regular)
-    source_1_width, source_1_height = draw.textsize(source_1, font=font_regular)
-    source_2_width, source_2_height = draw.textsize(source_2, font=font_regular)
+    footer_1_width, footer_1_height = text_size(footer_1, font_regular)
+    footer_2_width, footer_2_height = text_size(footer_2, font_regular)
+    source_1_width, source_1_height = text_size(source_1, font_regular)
+    source_2_width, source_2_height = text_size(source_2, font_regular)
     footer_width = max(footer_1_width, footer_2_width)
 
     # draw title
-    draw.text(((img_width - title_width) / 2, 10),
-              title,
-              font=font_regular,
-              fill=(0, 0, 0))
-    draw.text(((img_width - title2_width) / 2, 10 + title_height),
-              title2,
-              font=font_regular,
-              fill=(0, 0, 0))
+    draw_label(img, ((img_width - title_width) / 2, 10 - offset_y),
+               title,
+               font_regular,
+               (0, 0, 0))
+    draw_label(img, ((img_width - title2_width) / 2, 10 + title_height - offset_y),
+               title2,
+               font_regular,
+               (0, 0, 0))
 
     # draw subtitle
-    draw.text((margin, 10 + title_height * 3),
-              sub_title_1,
-              font=font_regular,
-              fill=(0, 0, 0))
-    if data[-1]["total_deaths"] > 5000:
-        draw.text((margin,
-                   10 + title_height * 3 + sub_title_1_height),
-                  sub_title_2,
-                  font=font_regular,
-                  fill=(0, 0, 0))
+    draw_label(img, (margin, 10 + title_height * 3 - offset_y),
+               sub_title_1,
+               font_regular,
+               (0, 0, 0))
+    if data.smoothing:
+        draw_label(img, (margin,
+                          10 + title_height * 3 + sub_title_1_height - offset_y),
+                   sub_title_2,
+                   font_regular,
+                   (0, 0, 0))
 
     # draw day legend
-    draw.text((img_width - margin - margin_right + day_line_margin,
-               margin + margin_top - days_height),
-              days,
-              font=font_regular,
-              fill=(255, 0, 0))
+    draw_label(img, (img_width - margin - margin_right + layout.day_line_margin,
+                      margin + margin_top - days_height - offset_y),
+               days,
+               font_regular,
+               (255, 0, 0))
 
     # draw source information
-    draw.text((margin,
-               img_height - margin_bottom - source_2_height),
-              source_1,
-              font=font_regular,
-              fill=(0, 0, 0))
-    draw.text((margin,
-               img_height - margin_bottom),
-              source_2,
-              font=font_regular,
-              fill=(0, 0, 0))
+    draw_label(img, (margin,
+                      img_height - margin_bottom - source_2_height),
+               source_1,
+               font_regular,
+               (0, 0, 0))
+    draw_label(img, (margin,
+                      img_height - margin_bottom),
+               source_2,
+               font_regular,
+               (0, 0, 0))
 
     # draw credit information
-    draw.text((img_width - margin - footer_1_width,
-               img_height - margin_bottom - footer_2_height),
-              footer_1,
-              font=font_regular,
-              fill=(0, 0, 0))
-    draw.text((img_width - margin - footer_2_width,
-               img_height - margin_bottom),
-              footer_2,
-              font=font_regular,
-              fill=(0, 0, 0))
-
-    day_increment = 0
-    ten_thousand_deaths = 0
-    year = int(data[0]['date'][0:4])
+    draw_label(img, (img_width - margin - footer_1_width,
+                      img_height - margin_bottom - footer_2_height),
+               footer_1,
+               font_regular,
+               (0, 0, 0))
+    draw_label(img, (img_width - margin - footer_2_width,
+                      img_height - margin_bottom),
+               footer_2,
+               font_regular,
+               (0, 0, 0))
 
-    # show major lines depending on the total number of deaths
-    if data[-1]["total_deaths"] > 1000000:
-        multiplier = 500000
-    elif data[-1]["total_deaths"] > 200000:
-        multiplier = 100000
-    elif data[-1]["total_deaths"] > 20000:
-        multiplier = 10000
-    elif data[-1]["total_deaths"] > 2000:
-        multiplier = 1000
-    elif data[-1]["total_deaths"] > 500:
-        multiplier = 250
-    elif data[-1]["total_deaths"] > 100:
-        multiplier = 50
-    elif data[-1]["total_deaths"] > 50:
-        multiplier = 20
-    else:
-        multiplier = 10
 
-    for day in data:
+def draw_day_annotations(img, data, layout, first_day=0, last_day=None, offset_y=0, counters=None):
+    """Draws the day ticks, the lines every multiple of deaths and the new year lines, with their texts
 
-        single_victim = 0
-        line_y = margin + margin_top + day_increment * line_multiplier
+    :param img: Image object that will be the final output image, or a horizontal strip of it
+    :param data: DaySeries that contains all data, formatted and ready to be used to draw the image output
+    :param layout: SimpleNamespace returned by layout_image
+    :param first_day: index of the first day whose annotations are drawn
+    :param last_day: index of the day after the last day whose annotations are drawn, None for the end of the series
+    :param offset_y: y coordinate of the top of the strip in the final image
+    :param counters: counters returned by the call that stopped at first_day, None to count again from the first day
+    of the series
+    :return: tuple (number of multiples of deaths passed, current year) at last_day, to carry on with the next days
+    """
+    margin = layout.margin
+    margin_right = layout.margin_right
+    day_line_margin = layout.day_line_margin
+    img_width = layout.img_width
+    multiplier = layout.multiplier
+    draw = ImageDraw.Draw(img)
+    if last_day is None:
+        last_day = layout.nb_days
 
-        # loop to print victims in the image randomly
-        while single_victim < day["moving_average"]:
-            pixel_x = random.randint(margin,
-                                     img_width - margin - margin_right - 1)
-            pixel_y = random.randint(margin_top + margin + day_increment * line_multiplier,
-                                     margin_top + margin + (day_increment + 1) * line_multiplier)
-            # check if the pixel is already "dead" to avoid the superposition of victims
-            if img.getpixel((pixel_x, pixel_y)) == (255, 255, 255):
-                img.putpixel((pixel_x, pixel_y), (0, 0, 0))
-                single_victim += 1
+    if counters is None:
+        ten_thousand_deaths, year = 0, data.year(0)
+        start_day = 0
+    else:
+        ten_thousand_deaths, year = counters
+        start_day = first_day
+
+    for day_increment in range(start_day, last_day):
+
+        line_y = margin + layout.margin_top + day_increment * layout.line_multiplier - offset_y
+        # the days before first_day only update the counters, their annotations are outside of the strip
+        visible = day_increment >= first_day
 
         # check if a multiple of 10k victims has passed
         # if so, a line is printed with the date and exact count
         # for areas with over 200k victims, the multiplier is set to 100000 to improve legibility
-        if int(day["total_deaths"] / multiplier) > ten_thousand_deaths:
-            ten_thousand_deaths = int(day["total_deaths"] / multiplier)
-            draw.line((margin - day_line_margin,
-                       line_y,
-                       img_width - margin - margin_right + ten_thousand_deaths_length,
-                       line_y),
-                      fill=(255, 0, 0),
-                      width=1)
-            print_ten_thousand_text(draw, day["total_deaths"], day["date"], line_y, text_left)
-        else:
+        if int(data.total_deaths[day_increment] / multiplier) > ten_thousand_deaths:
+            ten_thousand_deaths = int(data.total_deaths[day_increment] / multiplier)
+            if visible:
+                draw.line((margin - day_line_margin,
+                           line_y,
+                           img_width - margin - margin_right + layout.ten_thousand_deaths_length,
+                           line_y),
+                          fill=(255, 0, 0),
+                          width=1)
+                print_ten_thousand_text(img, data.total_deaths[day_increment], data.date(day_increment),
+                                        line_y, layout.text_left)
+        elif visible:
             draw.line((img_width - margin - margin_right + day_line_margin,
                        line_y,
-                       img_width - margin - margin_right + day_line_margin + day_line_length - 1,
+                       img_width - margin - margin_right + day_line_margin + layout.day_line_length - 1,
                        line_y),
                       fill=(255, 0, 0), width=1)
 
         # check if new year
         # if so, a line is printed with a text that shows both years
-        if year < int(day['date'][0:4]):
-            print_new_year(draw, year, line_y, img_width - 2 * margin)
-            draw.line((margin - day_line_margin,
-                       line_y,
-                       img_width - margin,
-                       line_y),
-                      fill=(0, 0, 255), width=1)
+        if year < data.year(day_increment):
+            if visible:
+                print_new_year(img, year, line_y, img_width - 2 * margin)
+                draw.line((margin - day_line_margin,
+                           line_y,
+                           img_width - margin,
+                           line_y),
+                          fill=(0, 0, 255), width=1)
             year += 1
-        # print("daily victims printed")
-        day_increment += 1
 
-    img.save('covid_' + region.lower() + '.png')
+    return ten_thousand_deaths, year
 
 
-def prepare_data(json_data, region):
+def draw_image(data, location, vectorized=True, metrics=None, compact=True, seed=None):
+    """Draws the image output from the data collected
+
+    :param data: DaySeries that contains all data, formatted and ready to be used to draw the image output
+    :param location: name of the country or region
+    :param vectorized: place the victims with numpy, band by band, instead of pixel by pixel (needs numpy)
+    :param compact: draw on a palette image instead of an RGB image, see new_canvas
+    :param metrics: dictionary filled with the placement and annotation times, the image size and the victims drawn
+    :param seed: seed of the random placement of the victims, see region_seed. None for a different image at each call
+    :return: Image object
     """
+    start = time.perf_counter()
+    placement_time = 0
+    nb_victims = 0
 
-    :param json_data: json object containing all data
-    :param region: region code to identify the country
-    :return: fake return to exit the function if the country has no death data
+    layout = layout_image(data)
+    margin = layout.margin
+    line_multiplier = layout.line_multiplier
+    img = new_canvas((layout.img_width, layout.img_height), compact)
+    draw_frame(img, data, location, layout)
+
+    # victims never overlap the annotations, so they are all placed before the annotations are drawn
+    placement_start = time.perf_counter()
+    if vectorized and np is not None:
+        victims = place_victims(data, layout.plot_width, line_multiplier, layout.scale, seed)
+        img.paste(pixel_value(img, BLACK), (margin, margin + layout.margin_top), Image.fromarray(victims))
+        nb_victims = int(victims.sum())
+    else:
+        # loop to print victims in the image randomly
+        rng = random.Random(seed)
+        for day_increment in range(layout.nb_days):
+            nb_victims += place_band_victims(img, margin, layout.margin_top + margin + day_increment * line_multiplier,
+                                             layout.plot_width, line_multiplier + 1,
+                                             math.ceil(data.moving_average[day_increment] / layout.scale), rng)
+    placement_time = time.perf_counter() - placement_start
+
+    draw_day_annotations(img, data, layout)
+
+    if metrics is not None:
+        metrics["placement"] = placement_time
+        metrics["annotations"] = time.perf_counter() - start - placement_time
+        metrics["width"], metrics["height"] = img.size
+        metrics["victims"] = nb_victims
+    return img
+
+
+def write_poster(data, location, path, line_multiplier=1, strip_height=64, metrics=None, compact=True,
+                 compress_level=6, seed=None):
+    """Renders the image at full resolution, without any limit on its width, strip by strip
+
+    Each horizontal strip is drawn, with the victims of its rows and the annotations that reach it, then streamed to
+    the PNG file, so the memory used depends on the width of the image and strip_height, not on its height. The file
+    is written next to path first and only replaces it if it is different, see replace_if_changed.
+
+    :param data: DaySeries that contains all data, formatted and ready to be used to draw the image output
+    :param location: name of the country or region
+    :param path: path of the PNG file
+    :param line_multiplier: height in pixels of each day
+    :param strip_height: number of rows drawn at a time
+    :param metrics: dictionary filled with the placement, annotation and save times and the image size, see draw_image
+    :param compact: write a palette image instead of an RGB image, see new_canvas
+    :param compress_level: zlib compression level of the PNG file, from 0 (none) to 9 (smallest file)
+    :param seed: seed of the random placement of the victims, see region_seed
+    :return: True if the file was written, False if it was already identical
     """
-    location = json_data[region]["location"]
-    full_data = []
+    if np is None:
+        raise RuntimeError("The poster mode needs numpy")
+
+    placement_time = 0
+    save_time = 0
+    start = time.perf_counter()
+    nb_victims = 0
+    layout = layout_image(data, line_multiplier)
+    plot_top = layout.margin + layout.margin_top
+    plot_bottom = plot_top + layout.nb_days * line_multiplier + 1
+    # texts are drawn up to about two lines of text above or below the line of their day
+    reach = 3 * layout.margin
+    rows = iter_victim_rows(data, layout.plot_width, line_multiplier, layout.scale, seed)
+
+    with open(path + ".tmp", "wb") as png_file:
+        writer = PngWriter(png_file, layout.img_width, layout.img_height, compress_level, PALETTE if compact else None)
+        for strip_top in range(0, layout.img_height, strip_height):
+            strip_bottom = min(strip_top + strip_height, layout.img_height)
+            strip = new_canvas((layout.img_width, strip_bottom - strip_top), compact)
+            if strip_top < plot_top + reach or strip_bottom > plot_bottom - reach:
+                draw_frame(strip, data, location, layout, strip_top)
+
+            placement_start = time.perf_counter()
+            first_row = max(strip_top, plot_top)
+            last_row = min(strip_bottom, plot_bottom)
+            if first_row < last_row:
+                victims = np.empty((last_row - first_row, layout.plot_width), dtype=bool)
+                for index in range(last_row - first_row):
+                    victims[index] = next(rows)
+                strip.paste(pixel_value(strip, BLACK), (layout.margin, first_row - strip_top), Image.fromarray(victims))
+                nb_victims += int(victims.sum())
+            placement_time += time.perf_counter() - placement_start
+
+            first_day = max(0, (strip_top - plot_top - reach) // line_multiplier)
+            last_day = min(layout.nb_days, (strip_bottom - plot_top + reach) // line_multiplier + 1)
+            if first_day < last_day:
+                draw_day_annotations(strip, data, layout, first_day, last_day, strip_top)
+
+            save_start = time.perf_counter()
+            writer.write_strip(strip)
+            save_time += time.perf_counter() - save_start
+        save_start = time.perf_counter()
+        writer.close()
+    written = replace_if_changed(path + ".tmp", path)
+    save_time += time.perf_counter() - save_start
+
+    if metrics is not None:
+        metrics["placement"] = placement_time
+        metrics["annotations"] = time.perf_counter() - start - placement_time - save_time
+        metrics["save"] = save_time
+        metrics["width"], metrics["height"] = layout.img_width, layout.img_height
+        metrics["victims"] = nb_victims
+    return written
+
+
+def write_animation(data, location, path, days_per_frame=7, delay=100, final_delay=3000, metrics=None,
+                    compress_level=6, seed=None):
+    """Renders a time-lapse of the image filling in, days_per_frame days at a time, as an animated PNG
+
+    All the frames are drawn on the same canvas: each one only adds the victims and the annotations of its own days,
+    and only the rows it changed are encoded and written at once. The drawing and encoding work grow with the number
+    of days, not with the number of frames, and the memory used does not depend on the number of frames. Like the
+    poster, the file only replaces path if it is different.
+
+    :param data: DaySeries that contains all data, formatted and ready to be used to draw the image output
+    :param location: name of the country or region
+    :param path: path of the animated PNG file
+    :param days_per_frame: number of days added by each frame
+    :param delay: number of milliseconds each frame is shown
+    :param final_delay: number of milliseconds the complete image is shown
+    :param metrics: dictionary filled with the placement, annotation and save times and the image size, see draw_image
+    :param compress_level: zlib compression level of the PNG file, from 0 (none) to 9 (smallest file)
+    :param seed: seed of the random placement of the victims, see region_seed
+    :return: True if the file was written, False if it was already identical
+    """
+    if np is None:
+        raise RuntimeError("The animation needs numpy")
+
+    start = time.perf_counter()
+    save_time = 0
+    layout = layout_image(data)
+    line_multiplier = layout.line_multiplier
+    plot_top = layout.margin + layout.margin_top
+    # texts are drawn up to about two lines of text above or below the line of their day
+    reach = 3 * layout.margin
+    img = new_canvas((layout.img_width, layout.img_height))
+    draw_frame(img, data, location, layout)
+
+    placement_start = time.perf_counter()
+    victims = place_victims(data, layout.plot_width, line_multiplier, layout.scale, seed)
+    victims_mask = Image.fromarray(victims)
+    placement_time = time.perf_counter() - placement_start
+    black = pixel_value(img, BLACK)
+    counters = None
+
+    with open(path + ".tmp", "wb") as png_file:
+        # the first frame is the empty graph, then one frame per group of days
+        writer = ApngWriter(png_file, layout.img_width, layout.img_height,
+                            math.ceil(layout.nb_days / days_per_frame) + 1, compress_level, PALETTE)
+        writer.write_frame(img, delay=delay)
+        for first_day in range(0, layout.nb_days, days_per_frame):
+            last_day = min(first_day + days_per_frame, layout.nb_days)
+            # the last row of a band is also the first row of the next day, it is added with the next frame
+            first_row = first_day * line_multiplier
+            last_row = last_day * line_multiplier + (1 if last_day == layout.nb_days else 0)
+            placement_start = time.perf_counter()
+            img.paste(black, (layout.margin, plot_top + first_row),
+                      victims_mask.crop((0, first_row, layout.plot_width, last_row)))
+            placement_time += time.perf_counter() - placement_start
+            counters = draw_day_annotations(img, data, layout, first_day, last_day, counters=counters)
+
+            save_start = time.perf_counter()
+            top = max(0, plot_top + first_row - reach)
+            bottom = min(layout.img_height, plot_top + last_row + reach)
+            writer.write_frame(img.crop((0, top, layout.img_width, bottom)), 0, top,
+                               final_delay if last_day == layout.nb_days else delay)
+            save_time += time.perf_counter() - save_start
+        save_start = time.perf_counter()
+        writer.close()
+    written = replace_if_changed(path + ".tmp", path)
+    save_time += time.perf_counter() - save_start
+
+    if metrics is not None:
+        metrics["placement"] = placement_time
+        metrics["annotations"] = time.perf_counter() - start - placement_time - save_time
+        metrics["save"] = save_time
+        metrics["width"], metrics["height"] = img.size
+        metrics["victims"] = int(victims.sum())
+    return written
+
+
+def generate_image(data, location, region, vectorized=True, metrics=None, poster=False, poster_line_multiplier=1,
+                   compact=True, compress_level=6, optimize=False, animation=False, animation_days=7,
+                   thumbnail_widths=(), seeded=False, encoder=None):
+    """Generates the image output from the data collected
+
+    :param data: DaySeries that contains all data, formatted and ready to be used to draw the image output
+    :param location: name of the country or region
+    :param region: code of the country or region
+    :param vectorized: place the victims with numpy, band by band, instead of pixel by pixel (needs numpy)
+    :param metrics: dictionary filled with the time spent in each stage of the rendering, see draw_image
+    :param poster: render a full resolution poster strip by strip instead of the web image, see write_poster
+    :param poster_line_multiplier: height in pixels of each day of the poster
+    :param compact: draw on a palette image instead of an RGB image, see new_canvas
+    :param compress_level: zlib compression level of the PNG file, from 0 (none) to 9 (smallest file)
+    :param optimize: let Pillow search for the smallest encoding of the PNG file, slower (not used by posters and
+    animations)
+    :param animation: render a time-lapse of the image filling in instead of the web image, see write_animation
+    :param animation_days: number of days added by each frame of the animation
+    :param thumbnail_widths: widths in pixels of the thumbnails saved next to the web image, see thumbnail_path
+    :param seeded: place the victims with a seed derived from the region and its data, so that the same data always
+    gives the same files, whatever the order or the process the regions are rendered in. Files that are identical to
+    the ones on disk are not written again (metrics["written"] is the number of files written)
+    :param encoder: BackgroundEncoder the web image and its thumbnails are encoded and written in, generate_image then
+    returns as soon as the image is drawn (posters and animations are always written before it returns)
+    :return: path of the image
+    """
+    seed = region_seed(region, data) if seeded else None
+    if animation:
+        path = image_path(region, "_animation")
+        written = write_animation(data, location, path, animation_days, metrics=metrics, compress_level=compress_level,
+                                  seed=seed)
+        if metrics is not None:
+            metrics["written"] = int(written)
+        return path
+
+    if poster:
+        path = image_path(region, "_poster")
+        written = write_poster(data, location, path, poster_line_multiplier, metrics=metrics, compact=compact,
+                               compress_level=compress_level, seed=seed)
+        if metrics is not None:
+            metrics["written"] = int(written)
+        return path
+
+    img = draw_image(data, location, vectorized, metrics, compact, seed)
+    path = image_path(region)
+    if encoder is not None:
+        encoder.submit(region, write_web_image, img, region, compress_level, optimize, thumbnail_widths, metrics)
+    else:
+        write_web_image(img, region, compress_level, optimize, thumbnail_widths, metrics)
+    return path
+
+
+def write_web_image(img, region, compress_level=6, optimize=False, thumbnail_widths=(), metrics=None):
+    """Encodes and writes the web image of a region and its thumbnails, see generate_image
+
+    :param img: Image object returned by draw_image
+    :param region: code of the country or region
+    :param compress_level: zlib compression level of the PNG files, from 0 (none) to 9 (smallest file)
+    :param optimize: let Pillow search for the smallest encoding of the web image, slower
+    :param thumbnail_widths: widths in pixels of the thumbnails, see thumbnail_path
+    :param metrics: dictionary filled with the save time and the number of files written
+    :return: number of files written, the others were identical to the ones on disk
+    """
+    start = time.perf_counter()
+    path = image_path(region)
+    # resizing and zlib release the GIL, so the thumbnails are made from the image in memory while it is encoded
+    with concurrent.futures.ThreadPoolExecutor(len(thumbnail_widths) + 1) as executor:
+        pngs = {path: executor.submit(png_bytes, img, compress_level, optimize)}
+        if thumbnail_widths:
+            rgb_img = img.convert("RGB")
+            for width in thumbnail_widths:
+                pngs[thumbnail_path(region, width)] = executor.submit(thumbnail_png, rgb_img, width, compress_level)
+        written = sum(write_if_changed(png_path, png.result()) for png_path, png in pngs.items())
+    if metrics is not None:
+        metrics["save"] = time.perf_counter() - start
+        metrics["written"] = written
+    return written
+
+
+class BackgroundEncoder:
+    """Pool of threads that encode and write the web images while the next regions are drawn, see render_pipelined
+
+    Pillow releases the GIL while it compresses an image, so within a single process the encoding of a region
+    overlaps the placement of the victims of the next ones.
+    """
+
+    def __init__(self, workers=2):
+        """
+        :param workers: number of images encoded at the same time
+        """
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.futures = {}
+
+    def submit(self, region, function, *args):
+        """
+        :param region: code of the country or region the files written by the function belong to
+        :param function: function that encodes and writes the files, e.g. write_web_image
+        :param args: arguments of the function
+        :return: n/a
+        """
+        self.futures[region] = self.executor.submit(function, *args)
+
+    def pop(self, region):
+        """
+        :param region: code of the country or region
+        :return: future of the files of the region submitted since the last call, None if there are none
+        """
+        return self.futures.pop(region, None)
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+def png_bytes(img, compress_level=6, optimize=False):
+    """
+    :param img: Image object
+    :param compress_level: zlib compression level of the PNG file, from 0 (none) to 9 (smallest file)
+    :param optimize: let Pillow search for the smallest encoding of the PNG file, slower
+    :return: bytes of the image encoded as PNG
+    """
+    png_buffer = io.BytesIO()
+    img.save(png_buffer, format="PNG", compress_level=compress_level, optimize=optimize)
+    return png_buffer.getvalue()
+
+
+def thumbnail_path(region, width):
+    """
+    :param region: code of the country or region
+    :param width: width of the thumbnail in pixels
+    :return: file name of the thumbnail, e.g. covid_fra_200.png
+    """
+    return image_path(region, "_" + str(width))
+
+
+def thumbnail_png(img, width, compress_level=6):
+    """Downscales an image to a given width, keeping its proportions
+
+    :param img: RGB Image object, so that the victims are averaged into shades of gray
+    :param width: width of the thumbnail in pixels
+    :param compress_level: zlib compression level of the PNG file, from 0 (none) to 9 (smallest file)
+    :return: bytes of the thumbnail encoded as PNG
+    """
+    height = max(1, round(img.height * width / img.width))
+    return png_bytes(img.resize((width, height), Image.LANCZOS, reducing_gap=3.0), compress_level)
+
 
-    if not "total_deaths" in json_data[region]["data"][-1]:
+def write_gallery(manifest, width, index_path, sheet_path, columns=12):
+    """Writes an HTML index of the thumbnails of all the regions and a contact sheet that gathers them in one image
+
+    Only the thumbnails are read, not the full images.
+
+    :param manifest: dictionary of the images rendered, see load_manifest
+    :param width: width of the thumbnails used, one of the thumbnail_widths given to generate_image
+    :param index_path: path of the HTML page, None to skip it
+    :param sheet_path: path of the PNG contact sheet, None to skip it
+    :param columns: number of thumbnails per row of the contact sheet
+    :return: number of regions in the gallery
+    """
+    _, font_small = load_fonts()
+    regions = sorted((entry.get("location", code), code) for code, entry in manifest.items()
+                     if os.path.exists(thumbnail_path(code, width)))
+
+    if index_path:
+        with open(index_path, "w", encoding="utf-8") as index_file:
+            index_file.write("<!DOCTYPE html>\n<html>\n<head><meta charset=\"utf-8\"><title>COVID-19 deaths</title>"
+                             "</head>\n<body>\n")
+            for location, code in regions:
+                index_file.write('<a href="' + image_path(code) + '"><img src="' + thumbnail_path(code, width)
+                                 + '" width="' + str(width) + '" alt="' + html.escape(location) + '" title="'
+                                 + html.escape(location) + '"></a>\n')
+            index_file.write("</body>\n</html>\n")
+
+    if sheet_path and regions:
+        thumbnails = [Image.open(thumbnail_path(code, width)) for _, code in regions]
+        label_height = 12
+        columns = min(columns, len(thumbnails))
+        cell_height = max(thumbnail.height for thumbnail in thumbnails) + label_height
+        nb_rows = math.ceil(len(thumbnails) / columns)
+        sheet = Image.new(mode="RGB", size=(columns * width, nb_rows * cell_height), color=WHITE)
+        for index, ((location, code), thumbnail) in enumerate(zip(regions, thumbnails)):
+            left = (index % columns) * width
+            top = (index // columns) * cell_height
+            sheet.paste(thumbnail.convert("RGB"), (left, top))
+            draw_label(sheet, (left + 2, top + cell_height - label_height), location, font_small, BLACK)
+            thumbnail.close()
+        sheet.save(sheet_path)
+
+    return len(regions)
+
+
+def encode_image(data, location, vectorized=True, metrics=None, compact=True, compress_level=6, optimize=False,
+                 seed=None):
+    """Draws the image output and encodes it as PNG in memory
+
+    :param data: DaySeries that contains all data, formatted and ready to be used to draw the image output
+    :param location: name of the country or region
+    :param vectorized: place the victims with numpy, band by band, instead of pixel by pixel (needs numpy)
+    :param metrics: dictionary filled with the time spent in each stage of the rendering, see draw_image
+    :param compact: draw on a palette image instead of an RGB image, see new_canvas
+    :param compress_level: zlib compression level of the PNG file, from 0 (none) to 9 (smallest file)
+    :param optimize: let Pillow search for the smallest encoding of the PNG file, slower
+    :param seed: seed of the random placement of the victims, see region_seed
+    :return: bytes of the PNG file
+    """
+    img = draw_image(data, location, vectorized, metrics, compact, seed)
+    start = time.perf_counter()
+    png = png_bytes(img, compress_level, optimize)
+    if metrics is not None:
+        metrics["save"] = time.perf_counter() - start
+    return png
+
+
+def trim_country(country):
+    """Keeps only the fields of a country that are used by prepare_data
+
+    :param country: dictionary of a country as found in the Our World in Data JSON file
+    :return: dictionary with the location and, for each day, the date and the new and total deaths when known. The
+    country as it is if it has no location or no valid days, so that it fails on its own when it is rendered instead
+    of stopping the parsing of the file
+    """
+    try:
+        data = []
+        for day in country["data"]:
+            trimmed_day = {"date": day["date"]}
+            if "new_deaths" in day:
+                trimmed_day["new_deaths"] = day["new_deaths"]
+            if "total_deaths" in day:
+                trimmed_day["total_deaths"] = day["total_deaths"]
+            data.append(trimmed_day)
+        return {"location": country["location"], "data": data}
+    except (KeyError, TypeError):
+        return country
+
+
+def iter_countries(json_file, chunk_size=1 << 20):
+    """Parses the Our World in Data JSON file incrementally and yields one country at a time
+
+    Only the text of the country being decoded is kept in memory, so the peak memory usage is set by the largest
+    country instead of the whole file.
+
+    :param json_file: text file object containing a JSON object with the region codes as keys
+    :param chunk_size: number of characters read from the file at a time
+    :return: generator of (region code, trimmed country dictionary) tuples
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+
+    def read_more():
+        # the read size grows with the pending text so that decoding a large country is not retried too often
+        nonlocal buffer, pos, eof
+        chunk = json_file.read(max(chunk_size, len(buffer) - pos))
+        if not chunk:
+            eof = True
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+    def next_char():
+        # skips whitespace and returns the next significant character without consuming it
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos < len(buffer):
+                return buffer[pos]
+            if eof:
+                raise ValueError("Unexpected end of the JSON file")
+            read_more()
+
+    def next_value():
+        nonlocal pos
+        next_char()
+        while True:
+            try:
+                value, pos = decoder.raw_decode(buffer, pos)
+                return value
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                read_more()
+
+    if next_char() != "{":
+        raise ValueError("The JSON file must contain an object with the region codes as keys")
+    pos += 1
+    while next_char() != "}":
+        if buffer[pos] == ",":
+            pos += 1
+        region = next_value()
+        if next_char() != ":":
+            raise ValueError("Missing ':' after the region code " + region)
+        pos += 1
+        yield region, trim_country(next_value())
+
+
+def iter_countries_csv(csv_file):
+    """Parses the Our World in Data CSV file row by row and yields one country at a time
+
+    Only the columns used by prepare_data are kept. The rows of a country must follow each other, as in the file
+    published by Our World in Data. Empty cells are left out of the days, like the keys missing from the JSON file.
+
+    :param csv_file: text file object of the CSV file, opened with newline=""
+    :return: generator of (region code, trimmed country dictionary) tuples, see trim_country
+    """
+    reader = csv.reader(csv_file)
+    header = next(reader)
+    try:
+        columns = [header.index(column) for column in CSV_COLUMNS]
+    except ValueError:
+        raise ValueError("The CSV file must have the columns " + ", ".join(CSV_COLUMNS))
+    project = operator.itemgetter(*columns)
+
+    region = None
+    country = None
+    for row in reader:
+        iso_code, location, date, new_deaths, total_deaths = project(row)
+        if iso_code != region:
+            if country is not None:
+                yield region, country
+            region = iso_code
+            country = {"location": location, "data": []}
+        day = {"date": date}
+        if new_deaths:
+            day["new_deaths"] = float(new_deaths)
+        if total_deaths:
+            day["total_deaths"] = float(total_deaths)
+        country["data"].append(day)
+
+    if country is not None:
+        yield region, country
+
+
+def hash_series(location, data, options=None):
+    """Calculates a hash of everything the image of a region is drawn from
+
+    :param location: name of the country or region
+    :param data: DaySeries that contains all data, formatted and ready to be used to draw the image output
+    :param options: dictionary of the keyword arguments given to generate_image
+    :return: hexadecimal SHA-256 digest
+    """
+    series_hash = hashlib.sha256(location.encode("utf-8"))
+    series_hash.update(json.dumps(options or {}, sort_keys=True).encode("utf-8"))
+    for column in (data.dates, data.daily_deaths, data.total_deaths, data.moving_average):
+        series_hash.update(column.tobytes())
+    return series_hash.hexdigest()
+
+
+def load_manifest(manifest_path):
+    """Loads the manifest of the images rendered by the previous runs
+
+    :param manifest_path: path of the JSON manifest
+    :return: dictionary with the region codes as keys and {"hash": ..., "file": ...} as values, empty if not found
+    """
+    try:
+        with open(manifest_path) as manifest_file:
+            return json.load(manifest_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_manifest(manifest_path, manifest):
+    """Saves the manifest of the rendered images, replacing the previous one only once it is fully written
+
+    :param manifest_path: path of the JSON manifest
+    :param manifest: dictionary with the region codes as keys and {"hash": ..., "file": ...} as values
+    :return: n/a
+    """
+    with open(manifest_path + ".tmp", "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def build_series(country, smoothing=None):
+    """Builds the series drawn in the image of a country
+
+    :param country: dictionary of the country as found in the Our World in Data JSON file
+    :param smoothing: dictionary of keyword arguments given to smooth_batch, e.g. {"window": 14, "mode": "centered"}
+    :return: DaySeries, None if the country has no death data
+    """
+    full_data = read_series(country)
+    if full_data is not None:
+        # the moving average is not calculated for countries with very few deaths (threshold of smooth_batch)
+        smooth_batch([full_data], **(smoothing or {}))
+    return full_data
+
+
+def build_batch(countries, smoothing=None):
+    """Builds the series of countries as they are parsed and smooths them all at once, in a single (regions x days)
+    array
+
+    Only the location and the series of each country are kept, its days are dropped as soon as its series is built.
+    A country whose series cannot be read is kept as it is, so that it is read again, and fails on its own, when
+    rendered.
+
+    :param countries: iterable of (region code, trimmed country dictionary) tuples, see trim_country
+    :param smoothing: dictionary of keyword arguments given to smooth_batch, e.g. {"window": 14, "mode": "centered"}
+    :return: tuple (dictionary with the region codes as keys and the countries as values, reduced to their location
+    e.g. {"location": "France"} unless their series could not be read, dictionary with the codes of the countries read
+    as keys and their DaySeries as values, None if the country has no death data)
+    """
+    kept = {}
+    series = {}
+    for country_code, country in countries:
+        try:
+            data = read_series(country)
+            kept[country_code] = {"location": country["location"]}
+            series[country_code] = data
+        except Exception:
+            kept[country_code] = country
+    smooth_batch([data for data in series.values() if data is not None], **(smoothing or {}))
+    return kept, series
+
+
+def read_series(country):
+    """Reads the daily and total deaths of a country, without calculating the moving averages
+
+    Several series read this way can be smoothed at once with smooth_batch.
+
+    :param country: dictionary of the country as found in the Our World in Data JSON file
+    :return: DaySeries, None if the country has no death data
+    """
+    full_data = DaySeries()
+
+    if not "total_deaths" in country["data"][-1]:
         return None
 
     # this loop parses each day of the JSON file and adds the relevant processed data in a new dictionary file
-    for day in json_data[region]["data"]:
+    for day in country["data"]:
 
         date = day["date"]
         if "new_deaths" in day:
@@ -284,56 +1056,588 @@ def prepare_data(json_data, region):
         else:
             total_deaths = 0
 
-        # do not calculate the moving average for countries with very few deaths
-        if len(full_data) >= 7 and json_data[region]["data"][-1]["total_deaths"] > 5000:
-            moving_average = calc_moving_average(full_data, 7)
-        else:
-            moving_average = daily_deaths
+        full_data.append(date, daily_deaths, total_deaths)
+
+    return full_data
+
+
+def estimate_cost(data, options=None):
+    """Estimates the time and the memory needed to render the images of a region, from its series only
+
+    The victims placed and the size of the image are known from layout_image without drawing anything. The memory is
+    the one of the canvas and of the array of the victims, only for a strip of the image for posters.
+
+    :param data: DaySeries, smoothed like the series rendered
+    :param options: dictionary of keyword arguments given to generate_image
+    :return: tuple (number of seconds, number of bytes), see predict_cost
+    """
+    options = options or {}
+    layout = layout_image(data, options.get("poster_line_multiplier", 1) if options.get("poster") else None)
+    victims = sum(math.ceil(moving_average / layout.scale) for moving_average in data.moving_average
+                  if moving_average > 0)
+    pixels = layout.img_width * layout.img_height
+    # canvas and boolean array of the victims
+    bytes_per_pixel = (1 if options.get("compact", True) or options.get("animation") else 3) + 1
+    drawn = pixels
+    if options.get("poster"):
+        # the default strip height of write_poster
+        memory = layout.img_width * 64 * bytes_per_pixel
+    else:
+        memory = pixels * bytes_per_pixel
+    if options.get("animation"):
+        # each frame encodes again the rows of the texts around its days, and the mask of the victims is kept
+        drawn += math.ceil(layout.nb_days / options.get("animation_days", 7)) * 6 * layout.margin * layout.img_width
+        memory += pixels
+    elif options.get("thumbnail_widths"):
+        # the thumbnails are resized from an RGB copy of the image
+        drawn += pixels * len(options["thumbnail_widths"])
+        memory += pixels * 3
+    return predict_cost(victims, drawn, len(data)), memory
+
 
-        date_data = {"date": date,
-                     "daily_deaths": daily_deaths,
-                     "total_deaths": total_deaths,
-                     "moving_average": moving_average
-                     }
-        full_data.append(date_data.copy())
+def estimate_countries(countries, manifest=None, options=None, series=None):
+    """Estimates the cost of each country of a batch before any is rendered, see estimate_cost
 
-    generate_image(full_data, location, region)
+    :param countries: dictionary with the region codes as keys and the country dictionaries as values, only their
+    location is needed when their series are given
+    :param manifest: dictionary of the images already rendered, see load_manifest. The countries whose image is
+    unchanged only cost the building of their series
+    :param options: dictionary of keyword arguments given to generate_image, and of the smoothing given to
+    build_series under the "smoothing" key
+    :param series: dictionary of the series of the countries, see build_batch. None to build them
+    :return: dictionary with the region codes as keys and (number of seconds, number of bytes) tuples as values. A
+    country whose cost cannot be estimated, e.g. without any day or with an invalid date, gets the cost of an empty one
+    """
+    image_options = dict(options or {})
+    smoothing = image_options.pop("smoothing", None)
+    if series is None:
+        countries, series = build_batch(countries.items(), smoothing)
+
+    estimates = {}
+    for country_code, country in countries.items():
+        try:
+            # a country left out of the series could not be read, see build_batch
+            data = series[country_code]
+            if data is None:
+                estimates[country_code] = (predict_cost(0, 0, 0), 0)
+                continue
+            previous = (manifest or {}).get(country_code)
+            if previous and os.path.exists(previous["file"]) \
+                    and previous["hash"] == hash_series(country["location"], data, options):
+                estimates[country_code] = (predict_cost(0, 0, len(data)), 0)
+            else:
+                estimates[country_code] = estimate_cost(data, image_options)
+        except Exception:
+            # the country is still rendered, and its worker reports the error
+            estimates[country_code] = (predict_cost(0, 0, 0), 0)
+    return estimates
+
+
+def prepare_data(json_data, region, manifest=None, metrics=None, options=None, encoder=None, series=None):
+    """
+
+    :param json_data: json object containing all data
+    :param region: region code to identify the country
+    :param manifest: dictionary of the images already rendered, see load_manifest. The image is not rendered again
+    if its series has not changed and its file still exists, and the manifest is updated once the image is exported
+    :param metrics: dictionary filled with the time spent in each stage and the size of the image, see draw_image
+    :param options: dictionary of keyword arguments given to generate_image, e.g. {"poster": True}, and of the
+    smoothing given to build_series under the "smoothing" key
+    :param encoder: BackgroundEncoder the web image is written in, see generate_image
+    :param series: DaySeries of the country already smoothed with the smoothing of the options, see build_batch.
+    None to build it
+    :return: name of the country once its graph is exported or found unchanged, None if the country has no death data
+    """
+    start = time.perf_counter()
+    location = json_data[region]["location"]
+    image_options = dict(options or {})
+    smoothing = image_options.pop("smoothing", None)
+    full_data = series if series is not None else build_series(json_data[region], smoothing)
+    if metrics is not None:
+        metrics["prepare"] = time.perf_counter() - start
+        metrics["days"] = len(full_data) if full_data is not None else 0
+    if full_data is None:
+        return None
+
+    if manifest is not None:
+        series_hash = hash_series(location, full_data, options)
+        previous = manifest.get(region)
+        if previous and previous["hash"] == series_hash and os.path.exists(previous["file"]):
+            print(location + " unchanged")
+            return location
+
+    path = generate_image(full_data, location, region, metrics=metrics, encoder=encoder, **image_options)
     print(location + " exported")
 
+    if manifest is not None:
+        manifest[region] = {"hash": series_hash, "file": path, "location": location}
+    return location
+
+
+def raise_timeout(signum, frame):
+    raise TimeoutError("Rendering took too long")
+
+
+def render_country(country_code, country, timeout, manifest_entry=None, profile_dir=None, options=None,
+                   encoder=None, series=None):
+    """Renders the graph of a single country, catching any error so that the batch goes on
+
+    :param country_code: region code to identify the country
+    :param country: trimmed dictionary of the country, see trim_country. Only its location is used when its series
+    is given
+    :param timeout: number of seconds after which the rendering is interrupted (ignored on systems without SIGALRM)
+    :param manifest_entry: entry of the country in the manifest of the previous run, None if it was not rendered
+    :param profile_dir: directory where the cProfile statistics of the country are dumped, None to disable profiling
+    :param options: dictionary of keyword arguments given to generate_image
+    :param encoder: BackgroundEncoder the web image is written in, see generate_image. The result is then only final
+    once its write is done, see finish_write
+    :param series: DaySeries of the country already smoothed, see build_batch. None to build it
+    :return: dictionary with the status, the error message, the rendering time, the new manifest entry and the
+    measures of each stage
+    """
+    start = time.time()
+    manifest = {country_code: manifest_entry} if manifest_entry else {}
+    metrics = {}
+    result = {"status": "exported", "error": None}
+    profiler = cProfile.Profile() if profile_dir else None
+    if hasattr(signal, "SIGALRM"):
+        signal.signal(signal.SIGALRM, raise_timeout)
+        signal.alarm(timeout)
+    try:
+        if profiler:
+            profiler.enable()
+        if not prepare_data({country_code: country}, country_code, manifest, metrics, options, encoder, series):
+            result["status"] = "no death data"
+        elif manifest.get(country_code) is manifest_entry:
+            result["status"] = "unchanged"
+    except Exception:
+        result["status"] = "error"
+        result["error"] = traceback.format_exc()
+    finally:
+        if hasattr(signal, "SIGALRM"):
+            signal.alarm(0)
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(profile_dir, country_code + ".prof"))
+    metrics["status"] = result["status"]
+    result["time"] = time.time() - start
+    result["manifest"] = manifest.get(country_code)
+    result["metrics"] = metrics
+    return result
+
+
+def collect_result(results, manifest, country_code, result):
+    """Records the result of a country and its new entry in the manifest
+
+    :param results: dictionary of the results of the batch, with the region codes as keys
+    :param manifest: dictionary of the images already rendered, see load_manifest
+    :param country_code: region code to identify the country
+    :param result: dictionary returned by render_country
+    :return: n/a
+    """
+    results[country_code] = result
+    if result.get("manifest"):
+        manifest[country_code] = result["manifest"]
+
+
+def render_in_process(countries, timeout, manifest=None, profile_dir=None, options=None):
+    """Renders each country one after the other in the current process
 
-def main():
+    :param countries: iterable of (region code, country dictionary) tuples
+    :param timeout: number of seconds allowed to render a single country
+    :param manifest: dictionary of the images already rendered, see load_manifest. It is updated with the new images
+    :param profile_dir: directory where the cProfile statistics of each country are dumped, None to disable profiling
+    :param options: dictionary of keyword arguments given to generate_image
+    :return: dictionary with the region codes as keys and the results of render_country as values
+    """
+    if manifest is None:
+        manifest = {}
+    results = {}
+    for country_code, country in countries:
+        collect_result(results, manifest, country_code,
+                       render_country(country_code, country, timeout, manifest.get(country_code), profile_dir,
+                                      options))
+    return results
+
+
+def render_in_pool(countries, workers, timeout, manifest=None, profile_dir=None, options=None, scheduled=False,
+                   memory_budget=None):
+    """Renders each country in a pool of worker processes
+
+    An error or a timeout only affects its own country. If a worker dies without returning, its country is
+    reported as lost once no other country has finished for twice the timeout.
+
+    When scheduled, only the location and the series of each country are kept as it is parsed, the series of all of
+    them are smoothed at once (see build_batch) and the cost of each one is estimated before the first one starts (see
+    estimate_countries). They are then started the most costly first, so that the largest regions do not start last
+    and set the duration of the batch, each worker being sent the location and the series of its country. Each one
+    only starts once the memory estimated for the countries being rendered leaves room for it, see CostScheduler.
+
+    :param countries: iterable of (region code, trimmed country dictionary) tuples, see trim_country
+    :param workers: number of worker processes
+    :param timeout: number of seconds allowed to render a single country
+    :param manifest: dictionary of the images already rendered, see load_manifest. It is updated with the new images
+    :param profile_dir: directory where the cProfile statistics of each country are dumped, None to disable profiling
+    :param options: dictionary of keyword arguments given to generate_image
+    :param scheduled: start the countries the most costly first instead of in the order of the file, and report the
+    predicted and measured costs
+    :param memory_budget: number of bytes estimated for the countries rendered at the same time when scheduled, None
+    for no limit
+    :return: dictionary with the region codes as keys and the results of render_country as values
+    """
+    if manifest is None:
+        manifest = {}
+    results = {}
+    scheduler = None
+    if scheduled:
+        countries, series = build_batch(countries, (options or {}).get("smoothing"))
+        for country_code in [country_code for country_code, data in series.items() if data is None]:
+            # nothing to draw, so no worker is needed
+            del countries[country_code], series[country_code]
+            collect_result(results, manifest, country_code,
+                           {"status": "no death data", "error": None, "time": 0, "manifest": manifest.get(country_code),
+                            "metrics": {"days": 0, "status": "no death data"}})
+        estimates = estimate_countries(countries, manifest, options, series)
+        scheduler = CostScheduler(estimates, workers, memory_budget)
+    # leaving the with block terminates the pool, which also kills the workers that are still stuck
+    with multiprocessing.Pool(workers) as pool:
+        pending = {}
+        # codes of the countries whose result is ready, so that the next one starts as soon as a worker is free
+        finished = queue.Queue()
+
+        def submit(country_code, country, data=None):
+            pending[country_code] = pool.apply_async(render_country,
+                                                     (country_code, country, timeout, manifest.get(country_code),
+                                                      profile_dir, options, None, data),
+                                                     callback=lambda _: finished.put(country_code),
+                                                     error_callback=lambda _: finished.put(country_code))
+
+        if scheduler is None:
+            for country_code, country in countries:
+                submit(country_code, country)
+
+        last_progress = time.time()
+        while pending or scheduler:
+            if scheduler is not None:
+                for country_code in scheduler.start():
+                    submit(country_code, countries.pop(country_code), series.pop(country_code, None))
+            try:
+                country_code = finished.get(timeout=max(0, last_progress + 2 * timeout - time.time()))
+            except queue.Empty:
+                for country_code in list(pending) + list(scheduler.waiting if scheduler is not None else []):
+                    results[country_code] = {"status": "error", "error": "worker lost or stuck", "time": None}
+                break
+            try:
+                result = pending.pop(country_code).get()
+            except Exception as e:
+                result = {"status": "error", "error": repr(e), "time": None}
+            if scheduler is not None:
+                scheduler.finish(country_code)
+            collect_result(results, manifest, country_code, result)
+            last_progress = time.time()
+
+    if scheduler is not None:
+        for country_code, result in results.items():
+            if result.get("metrics") is not None and country_code in estimates:
+                result["metrics"]["predicted"] = estimates[country_code][0]
+        print_cost_report(estimates, {country_code: result["time"] for country_code, result in results.items()},
+                          scheduler.order)
+    return results
+
+
+def finish_write(result, write):
+    """Waits for the files of a region written in the background and records their outcome in its result
+
+    :param result: dictionary returned by render_country
+    :param write: future of the write of the files of the region, None if nothing was written in the background
+    :return: the result, with the error status and without its manifest entry if the write failed
+    """
+    if write is not None:
+        try:
+            write.result()
+        except Exception:
+            result["status"] = "error"
+            result["error"] = traceback.format_exc()
+            result["manifest"] = None
+            result["metrics"]["status"] = "error"
+    return result
+
+
+def render_pipelined(countries, timeout, manifest=None, profile_dir=None, options=None, encoders=2, queue_size=8):
+    """Renders each country in the current process, overlapping the stages of consecutive countries
+
+    A thread parses the countries ahead of the one being drawn, and the web images are encoded and written by a
+    BackgroundEncoder while the next countries are drawn. Both queues are bounded by queue_size, so at most that many
+    parsed countries and drawn images are held in memory.
+
+    :param countries: iterable of (region code, country dictionary) tuples
+    :param timeout: number of seconds allowed to render a single country, without the write of its files
+    :param manifest: dictionary of the images already rendered, see load_manifest. It is updated with the new images
+    :param profile_dir: directory where the cProfile statistics of each country are dumped, None to disable profiling
+    :param options: dictionary of keyword arguments given to generate_image
+    :param encoders: number of images encoded at the same time
+    :param queue_size: number of countries parsed ahead and of images waiting to be written
+    :return: dictionary with the region codes as keys and the results of render_country as values
+    """
+    if manifest is None:
+        manifest = {}
+    results = {}
+    parsed = queue.Queue(queue_size)
+
+    def parse():
+        try:
+            for item in countries:
+                parsed.put(item)
+            parsed.put(None)
+        except BaseException as e:
+            parsed.put(e)
+
+    threading.Thread(target=parse, daemon=True).start()
+    encoder = BackgroundEncoder(encoders)
+    writing = collections.deque()
+    try:
+        while True:
+            item = parsed.get()
+            if item is None:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            country_code, country = item
+            result = render_country(country_code, country, timeout, manifest.get(country_code), profile_dir, options,
+                                    encoder)
+            writing.append((country_code, result, encoder.pop(country_code)))
+            # the results are collected in order, as soon as their files are written
+            while writing and (len(writing) > queue_size or writing[0][2] is None or writing[0][2].done()):
+                country_code, result, write = writing.popleft()
+                collect_result(results, manifest, country_code, finish_write(result, write))
+        for country_code, result, write in writing:
+            collect_result(results, manifest, country_code, finish_write(result, write))
+    finally:
+        encoder.shutdown()
+    return results
+
+
+def print_report(results):
+    """Prints a summary of a batch and the errors of each region that failed
+
+    :param results: dictionary returned by render_in_pool or render_in_process
+    :return: n/a
+    """
+    failed = {code: result for code, result in results.items() if result["status"] == "error"}
+    unchanged = [code for code, result in results.items() if result["status"] == "unchanged"]
+    # rendered again, e.g. after the manifest was lost, but with the same bytes as the files on disk
+    identical = [code for code, result in results.items() if (result.get("metrics") or {}).get("written") == 0]
+    print(str(len(results) - len(failed)) + " regions processed (" + str(len(unchanged)) + " unchanged, "
+          + str(len(identical)) + " identical on disk), " + str(len(failed)) + " failed")
+    for country_code, result in failed.items():
+        print("Error for " + country_code + " : " + result["error"])
+
+
+def main(regions=None, offline=None):
     """
     this is the URL for a JSON file maintained by Our World in Data containing data for all countries and regions
     change it with the URL of your choice
+
+    :param regions: list of region codes or glob patterns rendered instead of the region setting, see covid_cli.py
+    :param offline: path of a local copy of the data file used instead of the offline_path setting
     """
     # set the region for which you want to create the graph
     # exemples: France: FRA, United Kingdom: GBR, Taiwan: TWN, European Union: OWID_EUN, World: OWID_WRL ...
+    # a list of codes and glob patterns (e.g. ["FRA", "OWID_*"]) renders all the regions that match
     # to create graphs for each country and region, set this value to "all_countries"
     region = "all_countries"
+    # parse the file one country at a time instead of loading it whole, to keep memory usage low
+    streaming = True
+    # read the CSV export of Our World in Data instead of the JSON file: only the columns used by the graphs are
+    # kept, which is much faster to parse (always streamed)
+    csv_input = False
+    # number of processes rendering countries at the same time in "all_countries" mode (1 to render one by one)
+    workers = os.cpu_count() or 1
+    # number of seconds after which the rendering of a single country is considered stuck
+    timeout = 600
+    # render in a single process instead of a pool, overlapping the stages: the data file is parsed while it is
+    # downloaded, and rendered while the next countries are parsed, with pipeline_encoders threads encoding the images
+    # while the next ones are drawn. Uses much less memory than a pool of workers processes. pipeline_queue is the
+    # number of countries parsed ahead and of images waiting to be written. The file is only parsed while it is
+    # downloaded when it is parsed whole (all_countries or glob patterns)
+    pipelined = False
+    pipeline_encoders = 2
+    pipeline_queue = 8
+    # with several workers, parse every region first and estimate its cost from its series (victims placed and size
+    # of the image), then start them the most costly first so that the largest ones (World, continents) do not start
+    # last and set the duration of the batch. A region only starts once the memory estimated for the regions being
+    # rendered leaves room for it in memory_budget bytes (None for no limit). False to render them in the order of
+    # the file, as soon as they are parsed
+    scheduled = True
+    memory_budget = 2 << 30
+    # images whose data has not changed since the run recorded in this manifest are not rendered again
+    # (None to render every image)
+    manifest_path = "covid_manifest.json"
+    # compressed copy of the last download, only downloaded again when it has changed (None to disable the cache)
+    cache_path = "owid-covid-data.json.gz"
+    # set the path of a local copy of the file (.json or .json.gz) to render it without any network access
+    offline_path = None
+    # columnar copy of the data file, converted once per download and then read with mmap, so that a region is read
+    # without parsing the others (None to parse the data file at each run). A pipelined run that parses the file while
+    # it is downloaded never converts it, so that the regions are rendered meanwhile
+    store_path = "owid-covid-data.store"
+    # number of seconds without any answer from the server, and in total, after which a download attempt fails,
+    # number of attempts after the first one and number of seconds before the first retry (doubled for each retry)
+    download_options = {"timeout": 30, "max_time": 600, "retries": 3, "backoff": 2}
+    # report of the time spent in each stage for each region, as JSON or as CSV if the path ends with .csv
+    # (None to disable it)
+    metrics_path = "covid_metrics.json"
+    # set a directory to dump the cProfile statistics of each region in it (<region>.prof)
+    profile_dir = None
+    # render full resolution posters (covid_<region>_poster.png) strip by strip instead of the web images,
+    # with poster_line_multiplier pixels per day and without any limit on the width
+    poster = False
+    poster_line_multiplier = 1
+    # moving average of the daily deaths: number of days, mode ("trailing" for the mean of the previous days,
+    # "centered" or "exponential") and number of total deaths under which a region is not smoothed
+    smoothing = {"window": 7, "mode": "trailing", "threshold": 5000}
+    # draw on a palette image (white, black, red, blue and the shades of the texts) instead of an RGB image,
+    # which uses three times less memory and gives smaller files
+    compact = True
+    # zlib compression level of the PNG files, from 0 (none) to 9 (smallest file), and whether Pillow searches for
+    # the smallest encoding (slower). Level 9 saves about 12% but encodes up to 25 times slower on large images
+    compress_level = 6
+    optimize = False
+    # render animated PNG files (covid_<region>_animation.png) of the graphs filling in, animation_days days per frame,
+    # instead of the web images
+    animation = False
+    animation_days = 7
+    # widths of the thumbnails saved next to each web image (covid_<region>_<width>.png), e.g. [300, 100]
+    # and, when there are some, HTML index and contact sheet of the thumbnails of gallery_width pixels
+    thumbnail_widths = []
+    gallery_width = 100
+    # place the victims of each region with its own random generator, seeded from its code and its data, so that
+    # unchanged data always gives byte-identical files, which are then not written again (False for a new random
+    # placement at each run)
+    seeded = True
+    index_path = "covid_index.html"
+    contact_sheet_path = "covid_contact_sheet.png"
+
+    if regions is not None:
+        region = regions
+    if offline is not None:
+        offline_path = offline
 
-    req = urllib.request.Request(
-        "https://raw.githubusercontent.com/owid/covid-19-data/master/public/data/owid-covid-data.json")
+    url = "https://raw.githubusercontent.com/owid/covid-19-data/master/public/data/owid-covid-data.json"
+    if csv_input:
+        url = "https://raw.githubusercontent.com/owid/covid-19-data/master/public/data/owid-covid-data.csv"
+        if cache_path:
+            cache_path = cache_path.replace(".json", ".csv")
+    run_metrics = {}
+    options = {"compact": compact, "compress_level": compress_level, "optimize": optimize, "smoothing": smoothing}
+    if poster:
+        options.update(poster=poster, poster_line_multiplier=poster_line_multiplier)
+    if animation:
+        options.update(animation=animation, animation_days=animation_days)
+    if thumbnail_widths:
+        options.update(thumbnail_widths=thumbnail_widths)
+    if seeded:
+        options.update(seeded=seeded)
 
+    patterns = [region] if isinstance(region, str) else region
+    # without glob patterns, the file is only parsed until the regions are found: a file still being downloaded would
+    # then be closed before its end, and its compressed copy never completed
+    streamed = pipelined and (region == "all_countries" or any(is_glob(pattern) for pattern in patterns))
+    start = time.perf_counter()
     try:
-        response = urllib.request.urlopen(req)
+        if streamed:
+            response, downloaded = stream_data(url, cache_path, offline_path, **download_options)
+        else:
+            response, downloaded = open_data(url, cache_path, offline_path, **download_options)
     except HTTPError as e:
         print('Service unavailable.')
         print('Error : ', e.code)
-        exit(0)
+        exit(1)
     except URLError as e:
         print('Server unreachable.')
         print('Error : ', e.reason)
-        exit(0)
-    print("JSON downloaded")
+        exit(1)
+    run_metrics["download"] = time.perf_counter() - start
+    file_type = "CSV" if csv_input else "JSON"
+    if downloaded:
+        print(file_type + (" being downloaded" if streamed else " downloaded"))
+    else:
+        print(file_type + " read from disk")
 
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+
+    decode_times = {}
+    source_path = offline_path or cache_path
+    store = None
     with response as json_file:
-        json_data = json.load(json_file)
+        if csv_input:
+            countries = timed_iter(iter_countries_csv(io.TextIOWrapper(json_file, encoding="utf-8", newline="")),
+                                   decode_times)
+        elif streaming:
+            countries = timed_iter(iter_countries(io.TextIOWrapper(json_file, encoding="utf-8")), decode_times)
+        else:
+            start = time.perf_counter()
+            countries = [(country_code, trim_country(country))
+                         for country_code, country in json.load(json_file).items()]
+            run_metrics["decode"] = time.perf_counter() - start
 
-    if region == "all_countries":
-        for country in json_data:
-            prepare_data(json_data, country)
-    else:
-        prepare_data(json_data, region)
+        if store_path and source_path:
+            fresh = not downloaded and store_is_fresh(store_path, source_path)
+            # converting the whole file first would hold back the rendering of a streamed run until the download
+            # ends, so it only reads a store that is already up to date and parses the file otherwise
+            if not fresh and not streamed:
+                start = time.perf_counter()
+                print(str(write_store(store_path, countries, source_path)) + " regions converted to " + store_path)
+                run_metrics["convert"] = time.perf_counter() - start
+                fresh = True
+            if fresh:
+                store = ColumnStore(store_path)
+                countries = timed_iter(store.iter_countries(), decode_times)
+
+        manifest = load_manifest(manifest_path) if manifest_path else {}
+
+        if region != "all_countries":
+            if store is not None:
+                # only the days of the selected regions are read from the store
+                countries = timed_iter(((code, store.country(code)) for code in match_regions(store.regions, patterns)),
+                                       decode_times)
+            else:
+                countries = ((code, country) for code, country in countries if match_regions([code], patterns))
+                if not any(is_glob(pattern) for pattern in patterns):
+                    # the file is not parsed any further once all the regions are found
+                    countries = itertools.islice(countries, len(set(patterns)))
+
+        if region != "all_countries" and len(patterns) == 1 and not is_glob(patterns[0]):
+            results = render_in_process(countries, timeout, manifest, profile_dir, options)
+        elif pipelined:
+            results = render_pipelined(countries, timeout, manifest, profile_dir, options, pipeline_encoders,
+                                       pipeline_queue)
+        elif workers > 1:
+            results = render_in_pool(countries, workers, timeout, manifest, profile_dir, options, scheduled,
+                                     memory_budget)
+        else:
+            results = render_in_process(countries, timeout, manifest, profile_dir, options)
+    if store is not None:
+        store.close()
+    if region != "all_countries" and not results:
+        print("Region not found : " + ", ".join(patterns))
+    print_report(results)
+
+    if manifest_path:
+        save_manifest(manifest_path, manifest)
+
+    if gallery_width in thumbnail_widths:
+        print(str(write_gallery(manifest, gallery_width, index_path, contact_sheet_path)) + " regions in the gallery")
+
+    if metrics_path:
+        regions_metrics = {}
+        for country_code, result in results.items():
+            regions_metrics[country_code] = result.get("metrics") or {"status": result["status"]}
+            if country_code in decode_times:
+                regions_metrics[country_code]["decode"] = decode_times[country_code]
+        run_metrics["total"] = time.time() - start_time
+        write_metrics(metrics_path, run_metrics, regions_metrics)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,293 @@
+import argparse
+import datetime
+import io
+import json
+import math
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    # the resource module only exists on Unix, the peak memory is not reported elsewhere
+    resource = None
+
+# synthetic datasets, each one is run in a fresh process so that its peak memory is measured on its own
+# profile: "waves" for epidemic waves, "plateau" for days close to the capacity of their band,
+# "spike" for a single day with a huge revision
+SCENARIOS = {
+    "owid-small": {"source": "owid", "countries": 20, "days": 400, "peak": 500, "profile": "waves"},
+    "owid-typical": {"source": "owid", "countries": 250, "days": 1100, "peak": 2000, "profile": "waves"},
+    "owid-long": {"source": "owid", "countries": 20, "days": 3000, "peak": 2000, "profile": "waves"},
+    "owid-plateau": {"source": "owid", "countries": 10, "days": 800, "peak": 1500, "profile": "plateau"},
+    "owid-spike": {"source": "owid", "countries": 10, "days": 800, "peak": 1500, "profile": "spike"},
+    "fra-typical": {"source": "fra", "countries": 1, "days": 1100, "peak": 1000, "profile": "waves"},
+    "fra-plateau": {"source": "fra", "countries": 1, "days": 800, "peak": 1000, "profile": "plateau"},
+}
+DEFAULT_SCENARIOS = ["owid-small", "owid-typical", "owid-plateau", "owid-spike", "fra-typical", "fra-plateau"]
+
+
+def synthetic_deaths(nb_days, peak, profile, rng):
+    """Generates the daily deaths of a synthetic region
+
+    :param nb_days: number of days of the series
+    :param peak: highest number of deaths per day
+    :param profile: "waves", "plateau" or "spike", see SCENARIOS
+    :param rng: random.Random object
+    :return: list of integers
+    """
+    if profile == "plateau":
+        return [max(0, peak - rng.randint(0, max(1, peak // 50))) for _ in range(nb_days)]
+
+    deaths = []
+    nb_waves = 4
+    for day in range(nb_days):
+        value = 0
+        for wave in range(nb_waves):
+            center = (wave + 0.5) * nb_days / nb_waves
+            value += peak / (wave + 1) * math.exp(-((day - center) / (nb_days / 20)) ** 2)
+        deaths.append(max(0, int(value * rng.uniform(0.8, 1.2))))
+    if profile == "spike":
+        deaths[nb_days // 2] = peak * 10
+    return deaths
+
+
+def synthetic_owid(nb_countries, nb_days, peak, profile="waves", seed=0):
+    """Generates a dataset with the shape of the Our World in Data JSON file
+
+    The peaks of the countries follow a Zipf distribution from `peak` downwards and an OWID_WRL region sums them
+    all, like the World region of the real file. The first days have no death data, as in the real file.
+
+    :param nb_countries: number of countries
+    :param nb_days: number of days of each country
+    :param peak: highest number of deaths per day of the largest country
+    :param profile: "waves", "plateau" or "spike", see SCENARIOS
+    :param seed: seed of the random generator
+    :return: dictionary with the region codes as keys
+    """
+    rng = random.Random(seed)
+    first_day = datetime.date(2020, 1, 22)
+    dates = [(first_day + datetime.timedelta(days=day)).isoformat() for day in range(nb_days)]
+    first_death = min(30, nb_days // 10)
+    json_data = {}
+    world = [0] * nb_days
+
+    for country in range(nb_countries):
+        deaths = synthetic_deaths(nb_days, max(1, peak // (country + 1)), profile, rng)
+        world = [world_deaths + country_deaths for world_deaths, country_deaths in zip(world, deaths)]
+        json_data["C%03d" % country] = {"location": "Country %d" % country,
+                                        "data": owid_days(dates, deaths, first_death)}
+
+    json_data["OWID_WRL"] = {"location": "World", "data": owid_days(dates, world, first_death)}
+    return json_data
+
+
+def owid_days(dates, deaths, first_death):
+    """
+    :param dates: list of dates with format yyyy-mm-dd
+    :param deaths: list of the daily deaths
+    :param first_death: index of the first day with death data
+    :return: list of days with the keys and float values of the Our World in Data JSON file
+    """
+    days = []
+    total_deaths = 0
+    for index, (date, daily_deaths) in enumerate(zip(dates, deaths)):
+        day = {"date": date, "new_cases": float(daily_deaths * 40), "stringency_index": 50.0}
+        if index >= first_death:
+            total_deaths += daily_deaths
+            day["new_deaths"] = float(daily_deaths)
+            day["total_deaths"] = float(total_deaths)
+        days.append(day)
+    return days
+
+
+def synthetic_fra(nb_days, peak, profile="waves", seed=0):
+    """Generates a dataset with the shape of the data.gouv.fr JSON file, with cumulative counts
+
+    :param nb_days: number of days
+    :param peak: highest number of deaths per day
+    :param profile: "waves", "plateau" or "spike", see SCENARIOS
+    :param seed: seed of the random generator
+    :return: list of days
+    """
+    rng = random.Random(seed)
+    first_day = datetime.date(2020, 3, 1)
+    days = []
+    deaths = 0
+    deaths_ehpad = 0
+    for day, daily_deaths in enumerate(synthetic_deaths(nb_days, peak, profile, rng)):
+        deaths_ehpad += daily_deaths // 3
+        deaths += daily_deaths - daily_deaths // 3
+        days.append({"date": (first_day + datetime.timedelta(days=day)).isoformat(),
+                     "deces": deaths,
+                     "decesEhpad": deaths_ehpad if day >= 20 else None})
+    return days
+
+
+def peak_memory():
+    """
+    :return: peak resident memory of the process in MB, None if it can not be measured
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak / (1024 * 1024) if os.uname().sysname == "Darwin" else peak / 1024
+
+
+def count_victims(data):
+    """
+    :param data: DaySeries
+    :return: number of victims drawn in the image of the series
+    """
+    return sum(math.ceil(moving_average) for moving_average in data.moving_average if moving_average > 0)
+
+
+def run_scenario(name, vectorized, compact=True):
+    """Runs a scenario and times each stage separately
+
+    :param name: name of the scenario, see SCENARIOS
+    :param vectorized: place the victims with numpy instead of the pure Python loop
+    :param compact: draw on a palette image instead of an RGB image
+    :return: dictionary of measures
+    """
+    scenario = SCENARIOS[name]
+    if scenario["source"] == "owid":
+        import covid_deaths_graph as graph
+        payload = json.dumps(synthetic_owid(scenario["countries"], scenario["days"], scenario["peak"],
+                                            scenario["profile"])).encode("utf-8")
+    else:
+        import covid_deaths_graph_fra as graph
+        payload = json.dumps(synthetic_fra(scenario["days"], scenario["peak"], scenario["profile"])).encode("utf-8")
+
+    timings = {"parse": 0, "prepare": 0, "render": 0, "save": 0}
+    nb_regions = 0
+    nb_days = 0
+    nb_victims = 0
+    nb_pixels = 0
+    saved_bytes = 0
+
+    def render(data, location):
+        nonlocal nb_regions, nb_days, nb_victims, nb_pixels, saved_bytes
+        start = time.perf_counter()
+        if scenario["source"] == "owid":
+            img = graph.draw_image(data, location, vectorized, compact=compact)
+        else:
+            img = graph.draw_image(data, vectorized, compact=compact)
+        timings["render"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        with tempfile.TemporaryFile() as image_file:
+            img.save(image_file, format="PNG")
+            saved_bytes += image_file.tell()
+        timings["save"] += time.perf_counter() - start
+
+        nb_regions += 1
+        nb_days += len(data)
+        nb_victims += count_victims(data)
+        nb_pixels += img.width * img.height
+
+    if scenario["source"] == "owid":
+        countries = graph.iter_countries(io.TextIOWrapper(io.BytesIO(payload), encoding="utf-8"))
+        while True:
+            start = time.perf_counter()
+            country_code, country = next(countries, (None, None))
+            timings["parse"] += time.perf_counter() - start
+            if country_code is None:
+                break
+
+            start = time.perf_counter()
+            data = graph.build_series(country)
+            timings["prepare"] += time.perf_counter() - start
+            if data is not None:
+                render(data, country["location"])
+    else:
+        start = time.perf_counter()
+        json_data = json.loads(payload)
+        timings["parse"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        data = graph.build_series(json_data)
+        timings["prepare"] += time.perf_counter() - start
+        render(data, "France")
+
+    return {"scenario": name,
+            "vectorized": vectorized,
+            "compact": compact,
+            "payload_mb": len(payload) / (1024 * 1024),
+            "regions": nb_regions,
+            "days": nb_days,
+            "victims": nb_victims,
+            "pixels": nb_pixels,
+            "png_mb": saved_bytes / (1024 * 1024),
+            "timings": timings,
+            "parse_mb_per_s": len(payload) / (1024 * 1024) / max(timings["parse"], 1e-9),
+            "prepare_days_per_s": nb_days / max(timings["prepare"], 1e-9),
+            "render_victims_per_s": nb_victims / max(timings["render"], 1e-9),
+            "save_mpixels_per_s": nb_pixels / 1e6 / max(timings["save"], 1e-9),
+            "peak_memory_mb": peak_memory(),
+            }
+
+
+def run_isolated(name, vectorized, compact=True):
+    """Runs a scenario in a fresh process, so that its peak memory does not include the previous scenarios
+
+    :param name: name of the scenario, see SCENARIOS
+    :param vectorized: place the victims with numpy instead of the pure Python loop
+    :param compact: draw on a palette image instead of an RGB image
+    :return: dictionary of measures, or {"scenario": name, "error": message} if the scenario failed
+    """
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        try:
+            return pool.apply(run_scenario, (name, vectorized, compact))
+        except Exception as e:
+            return {"scenario": name, "error": repr(e)}
+
+
+def print_result(result):
+    """Prints the measures of a scenario on a single line
+
+    :param result: dictionary returned by run_scenario
+    :return: n/a
+    """
+    if "error" in result:
+        print("%-14s failed: %s" % (result["scenario"], result["error"]))
+        return
+    timings = result["timings"]
+    memory = "%.0f MB" % result["peak_memory_mb"] if result["peak_memory_mb"] is not None else "n/a"
+    print("%-14s parse %7.3fs  prepare %7.3fs  render %7.3fs  save %7.3fs  | %6.1f MB/s  %9.0f days/s  "
+          "%6.2f Mvictims/s  %6.1f Mpx/s  | peak %s"
+          % (result["scenario"], timings["parse"], timings["prepare"], timings["render"], timings["save"],
+             result["parse_mb_per_s"], result["prepare_days_per_s"], result["render_victims_per_s"] / 1e6,
+             result["save_mpixels_per_s"], memory))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the graph scripts on synthetic datasets, offline")
+    parser.add_argument("scenarios", nargs="*", default=DEFAULT_SCENARIOS, metavar="SCENARIO",
+                        help="scenarios to run among: " + ", ".join(sorted(SCENARIOS)))
+    parser.add_argument("--no-numpy", action="store_true",
+                        help="place the victims with the pure Python loop (much slower)")
+    parser.add_argument("--rgb", action="store_true", help="draw on RGB images instead of palette images")
+    parser.add_argument("--json", metavar="PATH", help="write the measures to this JSON file")
+    args = parser.parse_args(argv)
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario " + name)
+
+    results = []
+    for name in args.scenarios:
+        result = run_isolated(name, not args.no_numpy, not args.rgb)
+        print_result(result)
+        results.append(result)
+
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(results, json_file, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,92 +1,148 @@
-import urllib.request
 from urllib.error import URLError, HTTPError
+from array import array
+import base64
+import functools
+import hashlib
+import io
 import json
+import math
+import os
 import random
 from PIL import Image, ImageDraw, ImageFont
 import time
+import types
 from sys import exit
-
+from covid_download import open_data
+from covid_labels import draw_label, text_size
+from covid_metrics import write_metrics
+from covid_palette import BLACK, WHITE, new_canvas, pixel_value
+from covid_png import write_if_changed
+from covid_series import DaySeries, first_day_seed
+from covid_smoothing import exponential_averages, smooth_batch
+from covid_victims import band_capacity, place_band_victims, victim_scale
+
+try:
+    import numpy as np
+except ImportError:
+    # numpy is optional: without it, victims are placed one by one with the slower pure Python loop
+    np = None
+
+IMAGE_PATH = "covid.png"
+# version of the state saved for the incremental mode, the state of another version is ignored
+STATE_VERSION = 2
 
 start_time = time.time()
-font_regular = ImageFont.truetype("arial.ttf", size=10)
-font_small = ImageFont.truetype("arial.ttf", size=8)
 
 
-def calc_moving_average(data, n):
-    """Calculates the average of the last n values in the data dictionary
+@functools.lru_cache(maxsize=None)
+def load_fonts():
+    """Loads the fonts on the first call only, so that importing the script without rendering anything stays fast
 
-    :param data: dictionary
-    :param n: number of days used to calculate the moving average
-    :return: integer value of the average
+    :return: tuple (regular font, small font)
     """
-    past_n_days = data[-n:]
-    sum_values = 0
-    for day in past_n_days:
-        sum_values += day["daily_deaths"]
-    n_moving_average = int(sum_values / n)
-    return n_moving_average
+    return ImageFont.truetype("arial.ttf", size=10), ImageFont.truetype("arial.ttf", size=8)
 
 
-def print_ten_thousand_text(draw, total_deaths, date, line_y, text_left):
+def print_ten_thousand_text(img, total_deaths, date, line_y, text_left):
     """Draws a line every 10000 deaths, the date and the total exact number of deaths at this date
 
-    :param draw: ImageDraw object that will be the final output image
+    :param img: Image object that will be the final output image
     :param total_deaths: integer
     :param date: date with format yyyy-mm-dd
     :param line_y: y coordinate of the line that is drawn
     :param text_left: x coordinate from which the text must be drawn
     :return: n/a
     """
+    font_regular, font_small = load_fonts()
     line_y -= 2
     ten_thousand_text_date = date
-    ten_thousand_text_deaths = str(total_deaths)
-    ten_thousand_text_date_width, ten_thousand_text_date_height = draw.textsize(ten_thousand_text_date,
-                                                                                font=font_small)
-    ten_thousand_text_deaths_width, ten_thousand_text_deaths_height = draw.textsize(ten_thousand_text_deaths,
-                                                                                    font=font_regular)
-    draw.text((text_left, line_y - ten_thousand_text_deaths_height - ten_thousand_text_date_height),
-              ten_thousand_text_date,
-              font=font_small,
-              fill=(255, 0, 0))
-    draw.text((text_left, line_y - ten_thousand_text_deaths_height),
-              ten_thousand_text_deaths + " morts",
-              font=font_regular,
-              fill=(255, 0, 0))
-
-
-def print_new_year(draw, year, line_y, year_left):
+    ten_thousand_text_deaths = str(int(total_deaths))
+    ten_thousand_text_date_width, ten_thousand_text_date_height = text_size(ten_thousand_text_date, font_small)
+    ten_thousand_text_deaths_width, ten_thousand_text_deaths_height = text_size(ten_thousand_text_deaths, font_regular)
+    draw_label(img, (text_left, line_y - ten_thousand_text_deaths_height - ten_thousand_text_date_height),
+               ten_thousand_text_date,
+               font_small,
+               (255, 0, 0))
+    draw_label(img, (text_left, line_y - ten_thousand_text_deaths_height),
+               ten_thousand_text_deaths + " morts",
+               font_regular,
+               (255, 0, 0))
+
+
+def print_new_year(img, year, line_y, year_left):
     """Draws a line when a new year is beginning and writes the years
 
-    :param draw: ImageDraw object that will be the final output image
+    :param img: Image object that will be the final output image
     :param year: year that is ending
     :param line_y: y coordinate of the line that is drawn
     :param year_left: x coordinate from which the text with the year must be drawn
     :return: n/a
     """
+    font_regular, _ = load_fonts()
     line_y -= 1
     new_year = year + 1
-    year_width, year_height = draw.textsize(str(year), font=font_regular)
-    draw.text((year_left, line_y - year_height),
-              str(year),
-              font=font_regular,
-              fill=(0, 0, 255))
-    draw.text((year_left, line_y),
-              str(new_year),
-              font=font_regular,
-              fill=(0, 0, 255))
-
-
-def generate_image(data):
-    """Generates the image output from the data collected
-
-    :param data: dictionary that contains all data, formatted and ready to be used to draw the image output
-    :return: n/a
+    year_width, year_height = text_size(str(year), font_regular)
+    draw_label(img, (year_left, line_y - year_height),
+               str(year),
+               font_regular,
+               (0, 0, 255))
+    draw_label(img, (year_left, line_y),
+               str(new_year),
+               font_regular,
+               (0, 0, 255))
+
+
+def place_victims(data, plot_width, line_multiplier, scale=1, seed=None, day_offset=0, first_day=0, first_row=None):
+    """Places the victims of every day in a boolean array, with one batched random sample per day band
+
+    Each band covers line_multiplier + 1 rows, like the pure Python loop, so consecutive bands share a row and
+    a cell already used by the previous day is never picked twice.
+
+    :param data: DaySeries that contains all data, formatted and ready to be used to draw the image output
+    :param plot_width: width in pixels of the area where victims are drawn
+    :param line_multiplier: height in pixels of each day
+    :param scale: number of victims per pixel, see victim_scale
+    :param seed: seed of the random placement, see first_day_seed. None for a different placement at each call
+    :param day_offset: index in the whole series of the first day of data, when it only holds the last days
+    :param first_day: index in data of the first day placed, the rows of the days before are left empty
+    :param first_row: boolean numpy array of the victims already drawn on the first row of first_day, the last row
+    of the day before
+    :return: 2D boolean numpy array, True where a victim is drawn
+    """
+    victims = np.zeros((len(data) * line_multiplier + 1, plot_width), dtype=bool)
+    if first_row is not None:
+        victims[first_day * line_multiplier] = first_row
+    rng = np.random.default_rng(seed)
+
+    for day_increment in range(first_day, len(data)):
+        nb_victims = math.ceil(data.moving_average[day_increment] / scale)
+        if nb_victims <= 0:
+            continue
+        if seed is not None:
+            # one generator per day, so that the days added by an incremental run are placed as in a full render
+            rng = np.random.default_rng([seed, day_offset + day_increment])
+        # a slice of whole rows is contiguous, so ravel() returns a view and the band is filled in place
+        band = victims[day_increment * line_multiplier:(day_increment + 1) * line_multiplier + 1].ravel()
+        free_cells = np.flatnonzero(~band)
+        chosen = rng.choice(free_cells, size=min(nb_victims, free_cells.size), replace=False)
+        band[chosen] = True
+
+    return victims
+
+
+def layout_image(data, day_offset=0, first_date=None, max_moving_average=0):
+    """Calculates the size of the image and the position of its elements
+
+    :param data: DaySeries that contains all data, formatted and ready to be used to draw the image output
+    :param day_offset: number of days before the first day of data, when it only holds the last days of the series
+    :param first_date: date of the first day of the whole series with format yyyy-mm-dd, None for the first day of data
+    :param max_moving_average: highest moving average of the days before day_offset
+    :return: SimpleNamespace with the layout variables
     """
-
     # Variables used to set the layout. Small changes are generally fine.
-    nb_days = len(data)
+    nb_days = day_offset + len(data)
     margin = 15
-    max_moving_average = max(item['moving_average'] for item in data)
+    max_moving_average = max(max_moving_average, max(data.moving_average))
     margin_top = 50
     margin_bottom = 30
     margin_right = 6 * margin
@@ -96,19 +152,62 @@ def generate_image(data):
     ten_thousand_deaths_length = 3 * margin
 
     img_height = line_multiplier * nb_days + margin_top + margin_bottom + 2 * margin
-    img_width = int(max_moving_average / line_multiplier) + 2 * margin + margin_right
+    # rounded up so that the band of the busiest day can hold all its victims
+    img_width = math.ceil(max_moving_average / line_multiplier) + 2 * margin + margin_right
     text_left = img_width - margin_right
-    img = Image.new(mode="RGB", size=(img_width, img_height), color=(255, 255, 255))
-    draw = ImageDraw.Draw(img)
+
+    # a day that does not fit in its band would make the whole graph use several victims per pixel
+    plot_width = img_width - 2 * margin - margin_right
+    scale = victim_scale(max_moving_average, band_capacity(plot_width, line_multiplier))
+
+    return types.SimpleNamespace(nb_days=nb_days, margin=margin, margin_top=margin_top, margin_bottom=margin_bottom,
+                                 margin_right=margin_right, line_multiplier=line_multiplier,
+                                 day_line_length=day_line_length, day_line_margin=day_line_margin,
+                                 ten_thousand_deaths_length=ten_thousand_deaths_length, img_width=img_width,
+                                 img_height=img_height, text_left=text_left, plot_width=plot_width, scale=scale,
+                                 max_moving_average=max_moving_average, first_date=first_date or data.date(0),
+                                 last_date=data.date(-1))
+
+
+def title_text(layout):
+    """
+    :param layout: SimpleNamespace returned by layout_image
+    :return: main title of the graph
+    """
+    return "MORTS DU COVID-19 EN FRANCE DU " + layout.first_date + " AU " + layout.last_date
+
+
+def draw_frame(img, data, layout, subtitles=True):
+    """Draws the titles, the legend and the footer of the image
+
+    :param img: Image object that will be the final output image
+    :param data: DaySeries that contains all data, formatted and ready to be used to draw the image output
+    :param layout: SimpleNamespace returned by layout_image
+    :param subtitles: False when the subtitles are already on the image, see extend_image
+    :return: n/a
+    """
+    font_regular, _ = load_fonts()
+    margin = layout.margin
+    margin_bottom = layout.margin_bottom
+    img_width = layout.img_width
+    img_height = layout.img_height
 
     # Main title of the graph
-    title = "MORTS DU COVID-19 EN FRANCE DU " + data[0]['date'] + " AU " + data[-1]['date']
-    title_width, title_height = draw.textsize(title, font=font_regular)
+    title = title_text(layout)
+    title_width, title_height = text_size(title, font_regular)
 
     # Subtitle to give secondary information
-    sub_title_1 = "1 pixel noir = 1 décès"
-    sub_title_1_width, sub_title_1_height = draw.textsize(sub_title_1, font=font_regular)
-    sub_title_2 = "Décès lissés sur 7 jours"
+    if layout.scale == 1:
+        sub_title_1 = "1 pixel noir = 1 décès"
+    else:
+        sub_title_1 = "1 pixel noir = " + str(layout.scale) + " décès"
+    sub_title_1_width, sub_title_1_height = text_size(sub_title_1, font_regular)
+    if data.smoothing == "centered":
+        sub_title_2 = "Décès lissés sur " + str(data.window) + " jours, centrés"
+    elif data.smoothing == "exponential":
+        sub_title_2 = "Décès lissés exponentiellement sur " + str(data.window) + " jours"
+    else:
+        sub_title_2 = "Décès lissés sur " + str(data.window) + " jours"
 
     # Footer for credit information.
     footer_1 = "David Bertho"
@@ -116,104 +215,453 @@ def generate_image(data):
     source_1 = "Source : Ministère des Solidarités et de la Santé"
     source_2 = "data.gouv.fr"
 
-    footer_1_width, footer_1_height = draw.textsize(footer_1, font=font_regular)
-    footer_2_width, footer_2_height = draw.textsize(footer_2, font=font_regular)
-    source_1_width, source_1_height = draw.textsize(source_1, font=font_regular)
-    source_2_width, source_2_height = draw.textsize(source_2, font=font_regular)
+    footer_1_width, footer_1_height = text_size(footer_1, font_regular)
+    footer_2_width, footer_2_height = text_size(footer_2, font_regular)
+    source_1_width, source_1_height = text_size(source_1, font_regular)
+    source_2_width, source_2_height = text_size(source_2, font_regular)
     footer_width = max(footer_1_width, footer_2_width)
 
-    draw.text(((img_width - title_width) / 2, 10),
-              title,
-              font=font_regular,
-              fill=(0, 0, 0))
-
-    draw.text((margin, 10 + title_height * 2),
-              sub_title_1,
-              font=font_regular,
-              fill=(0, 0, 0))
-    draw.text((margin,
-               10 + title_height * 2 + sub_title_1_height),
-              sub_title_2,
-              font=font_regular,
-              fill=(0, 0, 0))
-
-    draw.text((margin,
-               img_height - margin_bottom - source_2_height),
-              source_1,
-              font=font_regular,
-              fill=(0, 0, 0))
-    draw.text((margin,
-               img_height - margin_bottom),
-              source_2,
-              font=font_regular,
-              fill=(0, 0, 0))
-
-    draw.text((img_width - margin - footer_1_width,
-               img_height - margin_bottom - footer_2_height),
-              footer_1,
-              font=font_regular,
-              fill=(0, 0, 0))
-    draw.text((img_width - margin - footer_2_width,
-               img_height - margin_bottom),
-              footer_2,
-              font=font_regular,
-              fill=(0, 0, 0))
-
-    day_increment = 0
-    ten_thousand_deaths = 0
-    year = int(data[0]['date'][0:4])
-
-    for day in data:
-
-        single_victim = 0
-        line_y = margin + margin_top + day_increment * line_multiplier
-
-        # loop to print victims in the image randomly
-        while single_victim < day["moving_average"]:
-            pixel_x = random.randint(margin,
-                                     img_width - margin - margin_right - 1)
-            pixel_y = random.randint(margin_top + margin + day_increment * line_multiplier,
-                                     margin_top + margin + (day_increment + 1) * line_multiplier)
-            # check if the pixel is already "dead" to avoid the superposition of victims
-            if img.getpixel((pixel_x, pixel_y)) == (255, 255, 255):
-                img.putpixel((pixel_x, pixel_y), (0, 0, 0))
-                single_victim += 1
+    draw_label(img, ((img_width - title_width) / 2, 10),
+               title,
+               font_regular,
+               (0, 0, 0))
+
+    if subtitles:
+        draw_label(img, (margin, 10 + title_height * 2),
+                   sub_title_1,
+                   font_regular,
+                   (0, 0, 0))
+    if subtitles and data.smoothing:
+        draw_label(img, (margin,
+                          10 + title_height * 2 + sub_title_1_height),
+                   sub_title_2,
+                   font_regular,
+                   (0, 0, 0))
+
+    draw_label(img, (margin,
+                      img_height - margin_bottom - source_2_height),
+               source_1,
+               font_regular,
+               (0, 0, 0))
+    draw_label(img, (margin,
+                      img_height - margin_bottom),
+               source_2,
+               font_regular,
+               (0, 0, 0))
+
+    draw_label(img, (img_width - margin - footer_1_width,
+                      img_height - margin_bottom - footer_2_height),
+               footer_1,
+               font_regular,
+               (0, 0, 0))
+    draw_label(img, (img_width - margin - footer_2_width,
+                      img_height - margin_bottom),
+               footer_2,
+               font_regular,
+               (0, 0, 0))
+
+
+def draw_day_annotations(img, data, layout, first_day=0, last_day=None, day_offset=0, counters=None):
+    """Draws the day ticks, the lines every 10000 deaths and the new year lines, with their texts
+
+    :param img: Image object that will be the final output image, None to only update the counters
+    :param data: DaySeries that contains all data, formatted and ready to be used to draw the image output
+    :param layout: SimpleNamespace returned by layout_image
+    :param first_day: index in data of the first day whose annotations are drawn
+    :param last_day: index in data of the day after the last day whose annotations are drawn, None for the end of data
+    :param day_offset: index in the whole series of the first day of data
+    :param counters: counters returned by the call that stopped at first_day, None to count again from the first day
+    of data
+    :return: tuple (number of multiples of 10000 deaths passed, current year) at last_day, to carry on with the next
+    days
+    """
+    margin = layout.margin
+    margin_right = layout.margin_right
+    day_line_margin = layout.day_line_margin
+    img_width = layout.img_width
+    draw = ImageDraw.Draw(img) if img is not None else None
+    if last_day is None:
+        last_day = len(data)
+
+    if counters is None:
+        ten_thousand_deaths, year = 0, data.year(0)
+        start_day = 0
+    else:
+        ten_thousand_deaths, year = counters
+        start_day = first_day
+
+    for day_increment in range(start_day, last_day):
+
+        line_y = margin + layout.margin_top + (day_offset + day_increment) * layout.line_multiplier
+        # the days before first_day only update the counters
+        visible = img is not None and day_increment >= first_day
 
         # check if a multiple of 10k victime has passed
         # if so, a line is printed with the date and exact count
-        if int(day["total_deaths"] / 10000) > ten_thousand_deaths:
-            ten_thousand_deaths = int(day["total_deaths"] / 10000)
-            draw.line((margin - day_line_margin,
-                       line_y,
-                       img_width - margin - margin_right + ten_thousand_deaths_length,
-                       line_y),
-                      fill=(255, 0, 0),
-                      width=1)
-            print_ten_thousand_text(draw, day["total_deaths"], day["date"], line_y, text_left)
-        else:
+        if int(data.total_deaths[day_increment] / 10000) > ten_thousand_deaths:
+            ten_thousand_deaths = int(data.total_deaths[day_increment] / 10000)
+            if visible:
+                draw.line((margin - day_line_margin,
+                           line_y,
+                           img_width - margin - margin_right + layout.ten_thousand_deaths_length,
+                           line_y),
+                          fill=(255, 0, 0),
+                          width=1)
+                print_ten_thousand_text(img, data.total_deaths[day_increment], data.date(day_increment),
+                                        line_y, layout.text_left)
+        elif visible:
             draw.line((img_width - margin - margin_right + day_line_margin,
                        line_y,
-                       img_width - margin - margin_right + day_line_margin + day_line_length - 1,
+                       img_width - margin - margin_right + day_line_margin + layout.day_line_length - 1,
                        line_y),
                       fill=(255, 0, 0), width=1)
 
         # check if new year
         # if so, a line is printed with a text that shows both years
-        if year < int(day['date'][0:4]):
-            print_new_year(draw, year, line_y, img_width - 2 * margin)
-            draw.line((margin - day_line_margin,
-                       line_y,
-                       img_width - margin,
-                       line_y),
-                      fill=(0, 0, 255), width=1)
+        if year < data.year(day_increment):
+            if visible:
+                print_new_year(img, year, line_y, img_width - 2 * margin)
+                draw.line((margin - day_line_margin,
+                           line_y,
+                           img_width - margin,
+                           line_y),
+                          fill=(0, 0, 255), width=1)
             year += 1
 
-        day_increment += 1
+    return ten_thousand_deaths, year
+
+
+def draw_image(data, vectorized=True, metrics=None, compact=True, seed=None, state=None):
+    """Draws the image output from the data collected
+
+    :param data: DaySeries that contains all data, formatted and ready to be used to draw the image output
+    :param vectorized: place the victims with numpy, band by band, instead of pixel by pixel (needs numpy)
+    :param compact: draw on a palette image instead of an RGB image, see new_canvas
+    :param metrics: dictionary filled with the placement and annotation times, the image size and the victims drawn
+    :param seed: seed of the random placement of the victims, see first_day_seed. None for a different image at each
+    call
+    :param state: dictionary filled with what an incremental run needs to extend the image, see series_state (needs
+    numpy)
+    :return: Image object
+    """
+    start = time.perf_counter()
+    placement_time = 0
+    nb_victims = 0
+
+    layout = layout_image(data)
+    margin = layout.margin
+    line_multiplier = layout.line_multiplier
+    img = new_canvas((layout.img_width, layout.img_height), compact)
+    draw_frame(img, data, layout)
+
+    # victims never overlap the annotations drawn below, so they can all be placed in one pass beforehand
+    vectorized = vectorized and np is not None
+    if vectorized:
+        placement_start = time.perf_counter()
+        victims = place_victims(data, layout.plot_width, line_multiplier, layout.scale, seed)
+        img.paste(pixel_value(img, BLACK), (margin, margin + layout.margin_top), Image.fromarray(victims))
+        placement_time = time.perf_counter() - placement_start
+        nb_victims = int(victims.sum())
+        draw_day_annotations(img, data, layout)
+        if state is not None:
+            state.update(series_state(data, layout, seed, victims[-1]), compact=compact)
+    else:
+        rng = random.Random(seed)
+        counters = None
+        for day_increment in range(layout.nb_days):
+            # loop to print victims in the image randomly, before the annotations of the day
+            placement_start = time.perf_counter()
+            nb_victims += place_band_victims(img, margin, layout.margin_top + margin + day_increment * line_multiplier,
+                                             layout.plot_width, line_multiplier + 1,
+                                             math.ceil(data.moving_average[day_increment] / layout.scale), rng)
+            placement_time += time.perf_counter() - placement_start
+            counters = draw_day_annotations(img, data, layout, day_increment, day_increment + 1, counters=counters)
+
+    if metrics is not None:
+        metrics["placement"] = placement_time
+        metrics["annotations"] = time.perf_counter() - start - placement_time
+        metrics["width"], metrics["height"] = img.size
+        metrics["victims"] = nb_victims
+    return img
+
+
+def generate_image(data, vectorized=True, metrics=None, compact=True, compress_level=6, optimize=False, seeded=False,
+                   state=None):
+    """Generates the image output from the data collected
+
+    :param data: DaySeries that contains all data, formatted and ready to be used to draw the image output
+    :param vectorized: place the victims with numpy, band by band, instead of pixel by pixel (needs numpy)
+    :param metrics: dictionary filled with the time spent in each stage of the rendering, see draw_image
+    :param compact: draw on a palette image instead of an RGB image, see new_canvas
+    :param compress_level: zlib compression level of the PNG file, from 0 (none) to 9 (smallest file)
+    :param optimize: let Pillow search for the smallest encoding of the PNG file, slower
+    :param seeded: place the victims with a seed derived from the first date, so that the same data always gives the
+    same file, whether it is drawn at once or extended day by day. The file is not written again if it is identical to
+    the one on disk
+    :param state: dictionary filled with what the next runs need to extend the image, see extend_image. Left empty
+    without numpy
+    :return: True if the file was written, False if it was already identical
+    """
+    seed = first_day_seed("FRA", data.date(0)) if seeded and data else None
+    if seed is None and state is not None:
+        # the next runs place the victims of the new days with the seed of the days already drawn
+        seed = random.getrandbits(64)
+    img = draw_image(data, vectorized, metrics, compact, seed, state)
+    return write_image(img, metrics, compress_level, optimize, state)
+
+
+def write_image(img, metrics=None, compress_level=6, optimize=False, state=None):
+    """Encodes the image and writes it in covid.png, unless the file is already identical
+
+    :param img: Image object returned by draw_image or extend_image
+    :param metrics: dictionary filled with the encoding time
+    :param compress_level: zlib compression level of the PNG file, from 0 (none) to 9 (smallest file)
+    :param optimize: let Pillow search for the smallest encoding of the PNG file, slower
+    :param state: state of the incremental mode, the hash of the file is added to it so that a file modified in
+    between is never extended
+    :return: True if the file was written, False if it was already identical
+    """
+    start = time.perf_counter()
+    png_buffer = io.BytesIO()
+    img.save(png_buffer, format="PNG", compress_level=compress_level, optimize=optimize)
+    written = write_if_changed(IMAGE_PATH, png_buffer.getvalue())
+    if state:
+        state["image_hash"] = hashlib.sha256(png_buffer.getvalue()).hexdigest()
+    if metrics is not None:
+        metrics["save"] = time.perf_counter() - start
+    return written
+
+
+def series_state(data, layout, seed, last_row, counters=None, average=None):
+    """Gathers what the next runs need to extend the image with new days, see extend_image
+
+    The last days are kept with their averages, enough of them to smooth the new days and to draw again the texts
+    of the annotations that reach below them.
+
+    :param data: DaySeries drawn, or only its last days when the image was itself extended
+    :param layout: SimpleNamespace returned by layout_image
+    :param seed: seed of the random placement of the victims, see place_victims
+    :param last_row: boolean numpy array of the victims drawn on the last row of the last day
+    :param counters: counters of draw_day_annotations at the first day of data, None if it is the first day drawn
+    :param average: untruncated exponential moving average of the last day, calculated from data if None
+    :return: dictionary that can be saved as JSON
+    """
+    # the texts of the annotations are less than 3 margins high
+    tail_days = min(len(data), max(data.window, math.ceil(3 * layout.margin / layout.line_multiplier) + 1))
+    tail_start = len(data) - tail_days
+    if data.smoothing == "exponential" and average is None:
+        average = exponential_averages(data.daily_deaths, data.window)[-1]
+    return {"version": STATE_VERSION, "first_date": layout.first_date, "last_date": layout.last_date,
+            "nb_days": layout.nb_days, "window": data.window, "smoothing": data.smoothing, "seed": seed,
+            "width": layout.img_width, "scale": layout.scale, "max_moving_average": layout.max_moving_average,
+            "last_row": base64.b64encode(np.packbits(last_row).tobytes()).decode("ascii"),
+            "counters": list(draw_day_annotations(None, data, layout, 0, tail_start, counters=counters)),
+            "tail_dates": [data.date(day) for day in range(tail_start, len(data))],
+            "tail_daily": data.daily_deaths[tail_start:].tolist(),
+            "tail_total": data.total_deaths[tail_start:].tolist(),
+            "tail_average": data.moving_average[tail_start:].tolist(),
+            "average": average}
+
+
+def load_state(state_path):
+    """Loads the state saved by the previous run, see series_state
+
+    :param state_path: path of the JSON state
+    :return: dictionary, empty if not found or saved by another version of the script
+    """
+    try:
+        with open(state_path) as state_file:
+            state = json.load(state_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    return state if state.get("version") == STATE_VERSION else {}
+
+
+def save_state(state_path, state):
+    """Saves the state of the incremental mode, replacing the previous one only once it is fully written
+
+    :param state_path: path of the JSON state
+    :param state: dictionary returned by series_state
+    :return: n/a
+    """
+    with open(state_path + ".tmp", "w") as state_file:
+        json.dump(state, state_file)
+    os.replace(state_path + ".tmp", state_path)
+
+
+def extension_obstacle(state, smoothing=None, compact=True, seeded=False):
+    """Checks that the image of the previous run can be extended with the settings of this run
+
+    :param state: state saved by the previous run, see series_state
+    :param smoothing: dictionary of keyword arguments given to smooth_batch, see build_series
+    :param compact: draw on a palette image instead of an RGB image, see new_canvas
+    :param seeded: place the victims with the seed derived from the first date, see generate_image
+    :return: reason why the image must be drawn again from the first day, None if it can be extended
+    """
+    smoothing = dict({"window": 7, "mode": "trailing", "threshold": None}, **(smoothing or {}))
+    if np is None:
+        return "numpy n'est pas installé"
+    if not compact or not state["compact"]:
+        # on an RGB image, the texts drawn again over themselves would get darker, see covid_labels.draw_label
+        return "image RGB (compact = False)"
+    if smoothing["threshold"] is not None:
+        return "seuil de lissage"
+    if smoothing["window"] != state["window"] or smoothing["mode"] != state["smoothing"]:
+        return "lissage modifié"
+    if seeded and state["seed"] != first_day_seed("FRA", state["first_date"]):
+        return "placement aléatoire modifié (seeded)"
+    if state["smoothing"] == "centered":
+        return "le lissage centré modifie les derniers jours déjà dessinés"
+    try:
+        with open(IMAGE_PATH, "rb") as image_file:
+            image_hash = hashlib.sha256(image_file.read()).hexdigest()
+    except FileNotFoundError:
+        return IMAGE_PATH + " introuvable"
+    if image_hash != state.get("image_hash"):
+        return IMAGE_PATH + " modifié depuis le dernier rendu"
+    return None
+
+
+def new_records(json_data, state):
+    """Finds the days of the JSON file after the last day drawn, checking that the days kept have not been revised
+
+    :param json_data: list of the days of the JSON file, see main
+    :param state: state saved by the previous run, see series_state
+    :return: list of the new days of the JSON file, None if the days kept in the state have changed
+    """
+    # the days are sorted by date, so the new ones are found from the end without going through the others
+    first_new = len(json_data)
+    while first_new > 0 and json_data[first_new - 1]["date"] > state["last_date"]:
+        first_new -= 1
+    kept = json_data[max(0, first_new - len(state["tail_dates"])):first_new]
+    if [day["date"] for day in kept] != state["tail_dates"] or \
+            [record_deaths(day) for day in kept] != state["tail_total"]:
+        return None
+    return json_data[first_new:]
+
+
+def extend_image(records, state, metrics=None):
+    """Extends the image of the previous run with new days, placing only their victims
+
+    The image is copied from covid.png down to the last row of the last day drawn. The days kept in the state are
+    smoothed again with the new ones, then the title, the footer and the annotations of the last days are drawn again
+    at their new place. The victims of each day are placed with their own generator (see place_victims), so the image
+    is the same as if all the days were drawn at once with the same seed.
+
+    :param records: new days of the JSON file, see new_records
+    :param state: state saved by the previous run, see series_state
+    :param metrics: dictionary filled like draw_image with the preparation time too, the victims being only the new
+    ones
+    :return: tuple (Image object, new state), None if the new days make the image wider or change its scale
+    """
+    start = time.perf_counter()
+    window = state["window"]
+    data = DaySeries(window)
+    for date, daily_deaths, total_deaths, moving_average in zip(state["tail_dates"], state["tail_daily"],
+                                                                state["tail_total"], state["tail_average"]):
+        data.append(date, daily_deaths, total_deaths, moving_average)
+    tail_days = len(data)
+    append_days(data, records)
+
+    average = None
+    if state["smoothing"] == "exponential":
+        averages = exponential_averages(data.daily_deaths[tail_days:], window, state["average"])
+        data.moving_average[tail_days:] = array("d", [int(value) for value in averages])
+        data.smoothing = "exponential"
+        average = averages[-1]
+    else:
+        # the days kept are at least window days long, so the averages of the new days are the ones of the whole series
+        smooth_batch([data], window, "trailing", threshold=None)
+        data.moving_average[:tail_days] = array("d", state["tail_average"])
+    prepare_time = time.perf_counter() - start
+
+    day_offset = state["nb_days"] - tail_days
+    layout = layout_image(data, day_offset, state["first_date"], state["max_moving_average"])
+    if layout.img_width != state["width"] or layout.scale != state["scale"]:
+        return None
+    margin = layout.margin
+    line_multiplier = layout.line_multiplier
+    plot_top = margin + layout.margin_top
+
+    img = new_canvas((layout.img_width, layout.img_height), True)
+    with Image.open(IMAGE_PATH) as previous:
+        img.paste(previous.crop((0, 0, layout.img_width, plot_top + state["nb_days"] * line_multiplier + 1)))
+    # the title has new dates, the subtitles do not change
+    font_regular, _ = load_fonts()
+    title_height = text_size(title_text(layout), font_regular)[1]
+    img.paste(pixel_value(img, WHITE), (0, 0, layout.img_width, 10 + 2 * title_height))
+    draw_frame(img, data, layout, subtitles=False)
+
+    placement_start = time.perf_counter()
+    last_row = np.unpackbits(np.frombuffer(base64.b64decode(state["last_row"]), dtype=np.uint8),
+                             count=layout.plot_width).astype(bool)
+    victims = place_victims(data, layout.plot_width, line_multiplier, layout.scale, state["seed"], day_offset,
+                            tail_days, last_row)
+    img.paste(pixel_value(img, BLACK), (margin, plot_top + day_offset * line_multiplier), Image.fromarray(victims))
+    placement_time = time.perf_counter() - placement_start
+    draw_day_annotations(img, data, layout, day_offset=day_offset, counters=state["counters"])
+
+    new_state = series_state(data, layout, state["seed"], victims[-1], state["counters"], average)
+    new_state["compact"] = True
+    if metrics is not None:
+        metrics["prepare"] = prepare_time
+        metrics["placement"] = placement_time
+        metrics["annotations"] = time.perf_counter() - start - prepare_time - placement_time
+        metrics["width"], metrics["height"] = img.size
+        metrics["victims"] = int(victims.sum() - last_row.sum())
+    return img, new_state
+
+
+def record_deaths(day):
+    """
+    :param day: day of the JSON file, see main
+    :return: total number of deaths at this date, in hospitals and nursing homes
+    """
+    # during the first days of the pandemic, nursing home deaths were not included in the file
+    # or were marked as "null"
+    if day.get("decesEhpad") is not None:
+        total_deaths_ehpad = day["decesEhpad"]
+    else:
+        total_deaths_ehpad = 0
+    return day["deces"] + total_deaths_ehpad
+
+
+def append_days(full_data, json_data):
+    """Appends days of the JSON file to a series, deriving their daily deaths from the cumulative counts
+
+    :param full_data: DaySeries, the daily deaths of the first day appended are counted from its last day
+    :param json_data: list of days of the JSON file, see main
+    :return: n/a
+    """
+    # this loop parses each day of the JSON file and adds the relevant processed data in a new dictionary file
+    for day in json_data:
+
+        date = day["date"]
+        total_deaths = record_deaths(day)
+
+        if full_data:
+            daily_deaths = total_deaths - full_data.total_deaths[-1]
+        else:
+            daily_deaths = total_deaths
+
+        full_data.append(date, daily_deaths, total_deaths)
+
 
-    img.save('covid.png')
+def build_series(json_data, smoothing=None):
+    """Builds the series drawn in the image from the cumulative counts of the JSON file
+
+    :param json_data: list of the days of the JSON file, see main
+    :param smoothing: dictionary of keyword arguments given to smooth_batch, e.g. {"window": 14, "mode": "centered"}.
+    Unlike the other countries, France is smoothed whatever its number of deaths unless a threshold is given
+    :return: DaySeries
+    """
+    full_data = DaySeries()
+    append_days(full_data, json_data)
+    smooth_batch([full_data], **dict({"threshold": None}, **(smoothing or {})))
+    return full_data
 
 
-def main():
+def main(offline=None):
 
     """
     this is the URL for a JSON file containing data for France
@@ -226,56 +674,101 @@ def main():
     }
     deces and decesEhpad count the number of deaths respectively in general hospitals and nursing homes
     They must be added to have the total count of deaths
-    """
 
-    req = urllib.request.Request("https://www.data.gouv.fr/fr/datasets/r/d2671c6c-c0eb-4e12-b69a-8e8f87fc224c")
-    full_data = []
+    :param offline: path of a local copy of the data file used instead of the offline_path setting
+    """
 
+    # compressed copy of the last download, only downloaded again when it has changed (None to disable the cache)
+    cache_path = "deces-france.json.gz"
+    # set the path of a local copy of the file (.json or .json.gz) to render it without any network access
+    offline_path = None
+    # number of seconds without any answer from the server, and in total, after which a download attempt fails,
+    # number of attempts after the first one and number of seconds before the first retry (doubled for each retry)
+    download_options = {"timeout": 30, "max_time": 600, "retries": 3, "backoff": 2}
+    # report of the time spent in each stage, as JSON or as CSV if the path ends with .csv (None to disable it)
+    metrics_path = "covid_metrics_fra.json"
+    # moving average of the daily deaths: number of days and mode ("trailing" for the mean of the previous days,
+    # "centered" or "exponential")
+    smoothing = {"window": 7, "mode": "trailing"}
+    # draw on a palette image (white, black, red, blue and the shades of the texts) instead of an RGB image,
+    # which uses three times less memory and gives smaller files
+    compact = True
+    # zlib compression level of the PNG file, from 0 (none) to 9 (smallest file), and whether Pillow searches for
+    # the smallest encoding (slower). Level 9 saves about 12% but encodes up to 25 times slower on large images
+    compress_level = 6
+    optimize = False
+    # place the victims with a random generator seeded from the data, so that unchanged data gives a byte-identical
+    # file, which is then not written again (False for a new random placement at each run)
+    seeded = True
+    # state of the last rendering (None to disable it): the next runs only parse the new days of the file and place
+    # their victims below the image already in covid.png, instead of drawing it again from the first day. Only the
+    # last days drawn are checked against the file: delete the state to take an older correction into account
+    state_path = "covid_fra_state.json"
+
+    if offline is not None:
+        offline_path = offline
+    url = "https://www.data.gouv.fr/fr/datasets/r/d2671c6c-c0eb-4e12-b69a-8e8f87fc224c"
+    run_metrics = {}
+    metrics = {}
+
+    start = time.perf_counter()
     try:
-        response = urllib.request.urlopen(req)
+        response, _ = open_data(url, cache_path, offline_path, **download_options)
     except HTTPError as e:
         print('Service indisponible.')
         print('Erreur : ', e.code)
-        exit(0)
+        exit(1)
     except URLError as e:
         print('Serveur inaccessible.')
         print('Erreur : ', e.reason)
-        exit(0)
+        exit(1)
+    run_metrics["download"] = time.perf_counter() - start
 
+    start = time.perf_counter()
     with response as json_file:
         json_data = json.load(json_file)
-
-    # this loop parses each day of the JSON file and adds the relevant processed data in a new dictionary file
-    for day in json_data:
-
-        # during the first days of the pandemic, nursing home deaths were not included in the file
-        # or were marked as "null"
-        if day.get("decesEhpad") is not None:
-            total_deaths_ehpad = day["decesEhpad"]
+    metrics["decode"] = time.perf_counter() - start
+
+    state = load_state(state_path) if state_path else {}
+    records = None
+    if state:
+        reason = extension_obstacle(state, smoothing, compact, seeded)
+        if reason is None:
+            records = new_records(json_data, state)
+            if records is None:
+                reason = "derniers jours modifiés dans le fichier"
+        if reason is not None:
+            print("Image redessinée depuis le premier jour : " + reason)
+
+    if records == []:
+        print("Aucun nouveau jour depuis le " + state["last_date"] + ", covid.png n'a pas été réécrit")
+        metrics["status"] = "unchanged"
+    else:
+        extended = extend_image(records, state, metrics) if records else None
+        if extended is not None:
+            img, new_state = extended
+            metrics["status"] = "extended"
+            metrics["days"] = new_state["nb_days"]
+            written = write_image(img, metrics, compress_level, optimize, new_state)
         else:
-            total_deaths_ehpad = 0
-
-        date = day["date"]
-        total_deaths = day["deces"] + total_deaths_ehpad
-
-        if full_data:
-            daily_deaths = total_deaths - full_data[-1]["total_deaths"]
-        else:
-            daily_deaths = total_deaths
-
-        if len(full_data) >= 7:
-            moving_average = calc_moving_average(full_data, 7)
-        else:
-            moving_average = daily_deaths
-
-        date_data = {"date": date,
-                     "daily_deaths": daily_deaths,
-                     "total_deaths": total_deaths,
-                     "moving_average": moving_average
-                     }
-        full_data.append(date_data.copy())
-
-    generate_image(full_data)
+            if records:
+                print("Image redessinée depuis le premier jour : l'image s'élargit")
+            start = time.perf_counter()
+            full_data = build_series(json_data, smoothing)
+            metrics["prepare"] = time.perf_counter() - start
+            metrics["days"] = len(full_data)
+            metrics["status"] = "exported"
+            new_state = {} if state_path else None
+            written = generate_image(full_data, metrics=metrics, compact=compact, compress_level=compress_level,
+                                     optimize=optimize, seeded=seeded, state=new_state)
+        if not written:
+            print("Image identique à celle sur le disque, covid.png n'a pas été réécrit")
+        if new_state:
+            save_state(state_path, new_state)
+
+    if metrics_path:
+        run_metrics["total"] = time.time() - start_time
+        write_metrics(metrics_path, run_metrics, {"FRA": metrics})
 
 
 if __name__ == '__main__':
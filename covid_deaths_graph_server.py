@@ -0,0 +1,262 @@
+import argparse
+import collections
+import io
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import URLError
+import covid_deaths_graph as graph
+from covid_download import open_data
+from covid_series import region_seed
+from covid_smoothing import MODES, smooth_batch
+
+JSON_URL = "https://raw.githubusercontent.com/owid/covid-19-data/master/public/data/owid-covid-data.json"
+CSV_URL = "https://raw.githubusercontent.com/owid/covid-19-data/master/public/data/owid-covid-data.csv"
+
+
+class PngCache:
+    """PNG images kept in memory, the least recently used ones are dropped once their total size exceeds max_bytes
+
+    Safe to use from several threads.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        :param max_bytes: total size of the images kept in memory, in bytes
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.images = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :param key: (region code, data version) tuple
+        :return: bytes of the PNG image, None if it is not in the cache
+        """
+        with self.lock:
+            png = self.images.get(key)
+            if png is None:
+                return None
+            self.images.move_to_end(key)
+            self.hits += 1
+            return png
+
+    def put(self, key, png):
+        """Adds an image just rendered, dropping the least recently used ones if the cache is full
+
+        :param key: (region code, data version) tuple
+        :param png: bytes of the PNG image
+        :return: n/a
+        """
+        with self.lock:
+            self.misses += 1
+            if key in self.images:
+                self.size -= len(self.images.pop(key))
+            if len(png) > self.max_bytes:
+                return
+            self.images[key] = png
+            self.size += len(png)
+            while self.size > self.max_bytes:
+                _, dropped = self.images.popitem(last=False)
+                self.size -= len(dropped)
+
+    def stats(self):
+        """
+        :return: dictionary with the number of images, their total size and the number of hits and misses
+        """
+        with self.lock:
+            return {"images": len(self.images), "bytes": self.size, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses}
+
+
+def load_regions(data_file, csv_input=False, options=None, smoothing=None):
+    """Parses the data file and builds the series of every region once, smoothing them all in a single batch
+
+    :param data_file: binary file object of the Our World in Data JSON or CSV file
+    :param csv_input: the file is the CSV export, see iter_countries_csv
+    :param options: dictionary of keyword arguments given to encode_image, part of the data version
+    :param smoothing: dictionary of keyword arguments given to smooth_batch
+    :return: dictionary with the lower case region codes as keys and (region code, location, DaySeries, data version)
+    tuples as values, without the regions that have no death data or whose data cannot be read
+    """
+    parse = graph.iter_countries_csv if csv_input else graph.iter_countries
+    regions = []
+    for region, country in parse(io.TextIOWrapper(data_file, encoding="utf-8", newline="")):
+        try:
+            series = graph.read_series(country)
+            if series is not None:
+                regions.append((region, country["location"], series))
+        except Exception:
+            # the other regions are still served
+            continue
+    smooth_batch([series for _, _, series in regions], **(smoothing or {}))
+    return {region.lower(): (region, location, series, graph.hash_series(location, series, options))
+            for region, location, series in regions}
+
+
+class RenderService:
+    """Dataset loaded once and images rendered on request, see PngCache"""
+
+    def __init__(self, cache, csv_input=False, cache_path=None, offline_path=None, options=None, smoothing=None):
+        """
+        :param cache: PngCache of the rendered images
+        :param csv_input: read the CSV export of Our World in Data instead of the JSON file
+        :param cache_path: path of the compressed copy of the data file, see open_data
+        :param offline_path: path of a local copy of the data file, used instead of the URL
+        :param options: dictionary of keyword arguments given to encode_image
+        :param smoothing: dictionary of keyword arguments given to smooth_batch
+        """
+        self.cache = cache
+        self.csv_input = csv_input
+        self.cache_path = cache_path
+        self.offline_path = offline_path
+        self.options = options or {}
+        self.smoothing = smoothing or {}
+        self.regions = {}
+        self.loaded_at = None
+        self.render_locks = collections.defaultdict(threading.Lock)
+        self.locks_lock = threading.Lock()
+
+    def reload(self):
+        """Loads the data file again, downloading it only if it has changed
+
+        The images of the regions whose data has not changed stay in the cache, the others are rendered again on
+        their next request since their data version is part of their key.
+
+        :return: number of regions with death data
+        """
+        url = CSV_URL if self.csv_input else JSON_URL
+        response, _ = open_data(url, self.cache_path, self.offline_path)
+        with response as data_file:
+            regions = load_regions(data_file, self.csv_input, self.options, self.smoothing)
+        # replaced at once, so requests being served keep a consistent view of the data
+        self.regions = regions
+        self.loaded_at = time.time()
+        return len(regions)
+
+    def image(self, region, entry=None):
+        """Returns the image of a region, rendering it only if it is not in the cache yet
+
+        :param region: region code, in any case
+        :param entry: entry of the region already looked up in self.regions, so that the image is still rendered if a
+        reload removes the region in between. None to look it up
+        :return: tuple (bytes of the PNG image, data version, False if it was rendered for this request), or None if
+        the region is unknown or has no death data
+        """
+        if entry is None:
+            entry = self.regions.get(region.lower())
+        if entry is None:
+            return None
+        code, location, series, version = entry
+        key = (code, version)
+        png = self.cache.get(key)
+        if png is not None:
+            return png, version, True
+
+        # concurrent requests of the same image wait for the first one instead of rendering it again
+        with self.locks_lock:
+            render_lock = self.render_locks[key]
+        with render_lock:
+            png = self.cache.get(key)
+            hit = png is not None
+            if not hit:
+                # seeded, so that an image dropped from the cache is rendered again with the same bytes as its ETag
+                png = graph.encode_image(series, location, seed=region_seed(code, series), **self.options)
+                self.cache.put(key, png)
+        with self.locks_lock:
+            self.render_locks.pop(key, None)
+        return png, version, hit
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """Serves /covid_<region>.png, /regions (JSON list of the regions), /stats and POST /reload"""
+
+    def send_body(self, status, content_type, body, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, value, status=200):
+        self.send_body(status, "application/json", json.dumps(value).encode("utf-8"))
+
+    def do_GET(self):
+        service = self.server.service
+        path = self.path.split("?")[0]
+        if path.startswith("/covid_") and path.endswith(".png"):
+            region = path[len("/covid_"):-len(".png")]
+            entry = service.regions.get(region.lower())
+            if entry is None:
+                self.send_json({"error": "unknown region or no death data"}, 404)
+                return
+            # the data version is known before rendering, so a browser that has the image does not cost a render
+            etag = '"' + entry[3] + '"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            png, version, hit = service.image(region, entry)
+            etag = '"' + version + '"'
+            self.send_body(200, "image/png", png, {"ETag": etag, "X-Cache": "hit" if hit else "miss"})
+        elif path == "/regions":
+            self.send_json([{"code": code, "location": location, "image": "/covid_" + code.lower() + ".png"}
+                            for code, location, _, _ in service.regions.values()])
+        elif path == "/stats":
+            self.send_json(dict(service.cache.stats(), regions=len(service.regions), loaded_at=service.loaded_at))
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        if self.path != "/reload":
+            self.send_json({"error": "not found"}, 404)
+            return
+        try:
+            self.send_json({"regions": self.server.service.reload()})
+        except URLError as e:
+            # the previous data is still served
+            self.send_json({"error": str(e)}, 502)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves the graphs of the Our World in Data regions, rendered on "
+                                                 "request and kept in memory")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on (default: 8000)")
+    parser.add_argument("--cache-mb", type=float, default=64,
+                        help="total size of the images kept in memory, in MB (default: 64)")
+    parser.add_argument("--csv", action="store_true", help="read the CSV export instead of the JSON file")
+    parser.add_argument("--cache-path", default="owid-covid-data.json.gz",
+                        help="compressed copy of the data file, only downloaded again when it has changed")
+    parser.add_argument("--offline", metavar="PATH", help="local copy of the data file, used without network access")
+    parser.add_argument("--smoothing", choices=MODES, default="trailing", help="moving average of the daily deaths")
+    parser.add_argument("--window", type=int, default=7, help="number of days of the moving average (default: 7)")
+    parser.add_argument("--compress-level", type=int, default=6, help="zlib compression level of the PNG images")
+    args = parser.parse_args()
+
+    cache_path = args.cache_path.replace(".json", ".csv") if args.csv else args.cache_path
+    service = RenderService(PngCache(int(args.cache_mb * 1024 * 1024)), args.csv, cache_path, args.offline,
+                            {"compress_level": args.compress_level}, {"window": args.window, "mode": args.smoothing})
+    start = time.perf_counter()
+    print(str(service.reload()) + " regions loaded in " + "%.1f" % (time.perf_counter() - start) + " s")
+
+    server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+    server.service = service
+    print("Serving on http://" + args.host + ":" + str(args.port) + "/regions")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,368 @@
+import argparse
+import asyncio
+import gzip
+import http.client
+import json
+import io
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from urllib.error import HTTPError, URLError
+
+# data files of the two scripts, with the compressed copy each one keeps between runs
+SOURCES = {
+    "owid": ("https://raw.githubusercontent.com/owid/covid-19-data/master/public/data/owid-covid-data.json",
+             "owid-covid-data.json.gz"),
+    "fra": ("https://www.data.gouv.fr/fr/datasets/r/d2671c6c-c0eb-4e12-b69a-8e8f87fc224c",
+            "deces-france.json.gz"),
+}
+# HTTP status codes after which a download is tried again, other errors are reported at once
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+# number of bytes read from the network and written to disk at a time
+CHUNK_SIZE = 1 << 16
+
+
+def open_snapshot(path):
+    """Opens a local copy of a data file, compressed with gzip or not
+
+    :param path: path of the file, compressed if it ends with .gz
+    :return: binary file object
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def download(url, target_file, headers=None, timeout=30, max_time=None, compress=False, on_chunk=None):
+    """Downloads a file chunk by chunk into a binary file object, replacing what it contained
+
+    Timeouts and network errors are raised as URLError, HTTP errors (including 304 Not Modified) as HTTPError.
+
+    :param url: URL of the file
+    :param target_file: binary file object open for writing and seeking
+    :param headers: dictionary of the headers of the request
+    :param timeout: number of seconds without any answer from the server after which the download fails
+    :param max_time: number of seconds after which the download fails even if data still comes in, None for no limit.
+    It is checked each time bytes arrive, so a server that stops sending is only given up after timeout more seconds
+    :param compress: compress the file with gzip while it is written
+    :param on_chunk: function called with the position and the bytes of each chunk, before compression, e.g.
+    DownloadStream.feed
+    :return: dictionary with the ETag and Last-Modified headers of the response
+    """
+    deadline = time.monotonic() + max_time if max_time else None
+    target_file.seek(0)
+    target_file.truncate()
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers or {}), timeout=timeout) as response:
+            output = gzip.GzipFile(fileobj=target_file, mode="wb") if compress else target_file
+            position = 0
+            while True:
+                # read1() returns as soon as some bytes arrive, unlike read() which waits for the whole chunk, so the
+                # deadline is also checked on a server that sends a few bytes at a time
+                chunk = response.read1(CHUNK_SIZE)
+                if not chunk:
+                    break
+                output.write(chunk)
+                if on_chunk:
+                    on_chunk(position, chunk)
+                position += len(chunk)
+                if deadline and time.monotonic() > deadline:
+                    raise TimeoutError("Download took more than " + str(max_time) + " seconds")
+            # read1() returns no more bytes when the connection is closed early, only the remaining length tells
+            if response.length:
+                raise http.client.IncompleteRead(b"", response.length)
+            if compress:
+                # closes the gzip stream only, the target file stays open
+                output.close()
+            return {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+    except HTTPError:
+        raise
+    except (OSError, http.client.HTTPException) as e:
+        # socket timeouts, connection resets and truncated responses are not wrapped by urlopen once the response
+        # has started
+        raise e if isinstance(e, URLError) else URLError(e)
+
+
+async def fetch(url, target_file, headers=None, timeout=30, max_time=None, retries=3, backoff=2, compress=False,
+                on_chunk=None):
+    """Downloads a file in a worker thread, trying again after network errors and temporary HTTP errors
+
+    :param url: URL of the file
+    :param target_file: binary file object open for writing and seeking, see download
+    :param headers: dictionary of the headers of the request
+    :param timeout: number of seconds without any answer from the server after which an attempt fails
+    :param max_time: number of seconds after which an attempt fails even if data still comes in, None for no limit
+    :param retries: number of attempts after the first one
+    :param backoff: number of seconds before the first retry, doubled before each of the next ones
+    :param compress: compress the file with gzip while it is written
+    :param on_chunk: function called with the position and the bytes of each chunk, see download. Each attempt starts
+    again from position 0
+    :return: dictionary with the ETag and Last-Modified headers of the response
+    """
+    for attempt in range(retries + 1):
+        try:
+            return await asyncio.to_thread(download, url, target_file, headers, timeout, max_time, compress, on_chunk)
+        except HTTPError as e:
+            if e.code not in RETRY_STATUS or attempt == retries:
+                raise
+            error = e
+        except URLError as e:
+            if attempt == retries:
+                raise
+            error = e
+        print("Download of " + url + " failed (" + str(error) + "), new attempt in " + str(backoff * 2 ** attempt)
+              + " s")
+        await asyncio.sleep(backoff * 2 ** attempt)
+
+
+async def update_cache(url, cache_path, **options):
+    """Downloads a file into its compressed copy, only if it has changed since the copy was made
+
+    The ETag and Last-Modified headers of the copy are stored next to it in cache_path + ".meta.json" and sent back
+    with the next request, so an unchanged file is not downloaded again. The payload is written to a temporary file
+    first so that an interrupted download never replaces the copy.
+
+    :param url: URL of the file
+    :param cache_path: path of the compressed copy of the file (.gz)
+    :param options: timeout, max_time, retries, backoff and on_chunk, see fetch
+    :return: True if the file was downloaded, False if the copy is up to date
+    """
+    meta_path = cache_path + ".meta.json"
+    headers = {}
+    if os.path.exists(cache_path) and os.path.exists(meta_path):
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+        if meta.get("url") == url:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+    try:
+        with open(cache_path + ".tmp", "wb") as cache_file:
+            meta = await fetch(url, cache_file, headers, compress=True, **options)
+    except HTTPError as e:
+        os.remove(cache_path + ".tmp")
+        if e.code == 304 and headers:
+            return False
+        raise
+    except BaseException:
+        os.remove(cache_path + ".tmp")
+        raise
+
+    os.replace(cache_path + ".tmp", cache_path)
+    meta["url"] = url
+    with open(meta_path, "w") as meta_file:
+        json.dump(meta, meta_file)
+    return True
+
+
+def open_data(url, cache_path=None, offline_path=None, **options):
+    """Opens the data file, downloading it only when it has changed since the last run
+
+    HTTPError and URLError are raised, as with urllib.request.urlopen, once all the attempts have failed.
+
+    :param url: URL of the data file
+    :param cache_path: path of the compressed copy of the file (.gz), see update_cache. None to always download the
+    file, into a temporary file
+    :param offline_path: path of a local file (.gz or not) used instead of the URL, without any network access
+    :param options: timeout, max_time, retries and backoff, see fetch
+    :return: tuple (binary file object, True if the file was downloaded, False if it was read from disk)
+    """
+    if offline_path:
+        return open_snapshot(offline_path), False
+
+    if not cache_path:
+        temporary_file = tempfile.TemporaryFile()
+        try:
+            asyncio.run(fetch(url, temporary_file, **options))
+        except BaseException:
+            temporary_file.close()
+            raise
+        temporary_file.seek(0)
+        return temporary_file, True
+
+    downloaded = asyncio.run(update_cache(url, cache_path, **options))
+    return open_snapshot(cache_path), downloaded
+
+
+class DownloadStream(io.RawIOBase):
+    """Binary file object that reads a file while it is being downloaded by another thread
+
+    The chunks are passed through a bounded queue, so the download waits when the reader falls behind instead of
+    holding the whole file in memory. When the compressed copy of the file is up to date, the copy is read instead.
+    """
+
+    def __init__(self, max_chunks=64):
+        """
+        :param max_chunks: number of chunks downloaded ahead of the reader
+        """
+        self.chunks = queue.Queue(max_chunks)
+        self.pending = memoryview(b"")
+        # file object read instead of the queue, once the download thread has put one in it
+        self.source = None
+        self.finished = False
+        # number of bytes put in the queue, an attempt that starts again only adds the bytes after them
+        self.delivered = 0
+        # set once it is known whether the file is downloaded or read from its copy, or if the download failed
+        self.started = threading.Event()
+        self.downloaded = None
+        self.error = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.source is not None:
+            return self.source.readinto(buffer)
+        while not self.pending and not self.finished:
+            item = self.chunks.get()
+            if item is None:
+                self.finished = True
+            elif isinstance(item, BaseException):
+                self.finished = True
+                raise item
+            elif isinstance(item, bytes):
+                self.pending = memoryview(item)
+            else:
+                self.source = item
+                return self.source.readinto(buffer)
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+    def put(self, item):
+        # the reader may have stopped reading, the item is then dropped instead of waiting forever
+        while not self.closed:
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def feed(self, position, chunk):
+        """Queues the bytes of a chunk not queued yet, called by the download thread, see download
+
+        :param position: position of the chunk in the file
+        :param chunk: bytes of the chunk
+        :return: n/a
+        """
+        if self.closed:
+            # not an OSError, so that the download is not tried again
+            raise RuntimeError("Download stream closed by its reader")
+        if position + len(chunk) <= self.delivered:
+            return
+        chunk = chunk[max(0, self.delivered - position):]
+        self.delivered += len(chunk)
+        self.put(chunk)
+        if not self.started.is_set():
+            self.downloaded = True
+            self.started.set()
+
+    def close(self):
+        if self.source is not None:
+            self.source.close()
+        super().close()
+
+
+def stream_data(url, cache_path=None, offline_path=None, max_chunks=64, **options):
+    """Opens the data file like open_data, but returns as soon as the first bytes arrive, so that the file can be
+    parsed while the rest of it is being downloaded
+
+    Errors before the first bytes are raised as with open_data. An error after them, once all the attempts have
+    failed, is raised by the read calls of the file object.
+
+    :param url: URL of the data file
+    :param cache_path: path of the compressed copy of the file (.gz), see update_cache. None to always download the
+    file
+    :param offline_path: path of a local file (.gz or not) used instead of the URL, without any network access
+    :param max_chunks: number of chunks downloaded ahead of the reader
+    :param options: timeout, max_time, retries and backoff, see fetch
+    :return: tuple (binary file object, True if the file is being downloaded, False if it is read from disk)
+    """
+    if offline_path:
+        return open_snapshot(offline_path), False
+
+    stream = DownloadStream(max_chunks)
+
+    def run():
+        try:
+            if cache_path:
+                downloaded = asyncio.run(update_cache(url, cache_path, on_chunk=stream.feed, **options))
+            else:
+                with tempfile.TemporaryFile() as temporary_file:
+                    asyncio.run(fetch(url, temporary_file, on_chunk=stream.feed, **options))
+                downloaded = True
+            if not downloaded:
+                stream.downloaded = False
+                stream.put(open_snapshot(cache_path))
+            else:
+                # an empty file has no chunk at all
+                stream.downloaded = True
+                stream.put(None)
+        except BaseException as e:
+            if stream.started.is_set():
+                stream.put(e)
+            else:
+                stream.error = e
+        finally:
+            stream.started.set()
+
+    threading.Thread(target=run, daemon=True).start()
+    stream.started.wait()
+    if stream.error is not None:
+        stream.close()
+        raise stream.error
+    return io.BufferedReader(stream, CHUNK_SIZE), stream.downloaded
+
+
+async def update_caches(sources, **options):
+    """Updates the compressed copies of several files at the same time
+
+    :param sources: dictionary with names as keys and (URL, cache path) tuples as values, see SOURCES
+    :param options: timeout, max_time, retries and backoff, see fetch
+    :return: dictionary with the names as keys and as values True if the file was downloaded, False if its copy was
+    up to date, or the exception raised by its last attempt
+    """
+    results = await asyncio.gather(*(update_cache(url, cache_path, **options) for url, cache_path in sources.values()),
+                                   return_exceptions=True)
+    return dict(zip(sources, results))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Downloads the data files of the graph scripts at the same time, "
+                                                 "only when they have changed")
+    parser.add_argument("sources", nargs="*", default=list(SOURCES), metavar="SOURCE",
+                        help="files to download among: " + ", ".join(SOURCES))
+    parser.add_argument("--timeout", type=float, default=30,
+                        help="seconds without any answer from the server before an attempt fails (default: 30)")
+    parser.add_argument("--max-time", type=float, default=600,
+                        help="seconds after which an attempt fails even if data still comes in (default: 600)")
+    parser.add_argument("--retries", type=int, default=3, help="attempts after the first one (default: 3)")
+    parser.add_argument("--backoff", type=float, default=2,
+                        help="seconds before the first retry, doubled before each of the next ones (default: 2)")
+    args = parser.parse_args()
+    for name in args.sources:
+        if name not in SOURCES:
+            parser.error("unknown source " + name)
+
+    results = asyncio.run(update_caches({name: SOURCES[name] for name in args.sources}, timeout=args.timeout,
+                                        max_time=args.max_time, retries=args.retries, backoff=args.backoff))
+    failed = False
+    for name, result in results.items():
+        if isinstance(result, BaseException):
+            failed = True
+            print(name + ": failed (" + str(result) + ")")
+        else:
+            print(name + ": " + ("downloaded" if result else "unchanged") + " -> " + SOURCES[name][1])
+    # a non-zero status tells the scheduler that nothing new can be rendered
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
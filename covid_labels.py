@@ -0,0 +1,86 @@
+import functools
+from PIL import Image, ImageDraw
+from covid_palette import SHADES, shade_index
+
+# number of distinct (text, font) pairs kept in each cache, shared by all the images rendered by the process
+LABEL_CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=LABEL_CACHE_SIZE)
+def text_size(text, font):
+    """Measures a text once per (text, font) pair, with the same result as ImageDraw.textsize
+
+    :param text: string to measure
+    :param font: FreeTypeFont used to draw the text
+    :return: tuple (width, height) in pixels
+    """
+    # the right and bottom of the bounding box from the origin, as the deprecated FreeTypeFont.getsize gave
+    _, _, right, bottom = font.getbbox(text)
+    return right, bottom
+
+
+@functools.lru_cache(maxsize=LABEL_CACHE_SIZE)
+def label_bitmap(text, font, start):
+    """Rasterizes a text once per (text, font, subpixel start) into a grayscale mask
+
+    :param text: string to rasterize
+    :param font: FreeTypeFont used to draw the text
+    :param start: fractional part of the (x, y) coordinates the text is drawn at, which changes its anti-aliasing
+    :return: tuple (mask as an "L" image, (x, y) offset of the mask from the integer coordinates of the text)
+    """
+    left, top, right, bottom = font.getbbox(text)
+    pad = font.size
+    canvas = Image.new("L", (right - min(left, 0) + 2 * pad, bottom - min(top, 0) + 2 * pad), 0)
+    ImageDraw.Draw(canvas).text((pad + start[0], pad + start[1]), text, font=font, fill=255)
+    bbox = canvas.getbbox()
+    if bbox is None:
+        return None, (0, 0)
+    return canvas.crop(bbox), (bbox[0] - pad, bbox[1] - pad)
+
+
+@functools.lru_cache(maxsize=LABEL_CACHE_SIZE)
+def palette_label(text, font, start, fill):
+    """Converts the mask of a text into the palette indices of its shades, see covid_palette
+
+    :param text: string to rasterize
+    :param font: FreeTypeFont used to draw the text
+    :param start: fractional part of the (x, y) coordinates the text is drawn at
+    :param fill: color of the text, one of the colors of covid_palette.COLORS
+    :return: tuple ("P" image of the shades, "1" mask of the pixels covered by the text, (x, y) offset), or
+    (None, None, (0, 0)) for an empty text
+    """
+    mask, offset = label_bitmap(text, font, start)
+    if mask is None:
+        return None, None, (0, 0)
+    # the coverage of each pixel is rounded to the nearest of the SHADES + 2 levels, from white to the color itself
+    levels = [round(value * (SHADES + 1) / 255) for value in range(256)]
+    shades = Image.frombytes("P", mask.size, mask.point([shade_index(fill, level) for level in levels]).tobytes())
+    covered = mask.point([255 if level > 0 else 0 for level in levels]).convert("1")
+    return shades, covered, offset
+
+
+def draw_label(img, xy, text, font, fill):
+    """Draws a text like ImageDraw.text, reusing the mask of the text when it was already drawn
+
+    On a palette image, the anti-aliasing of the text is kept with the shades of covid_palette instead of the
+    blending of ImageDraw, which only works with RGB images.
+
+    :param img: Image object to draw on
+    :param xy: (x, y) coordinates of the top left corner of the text
+    :param text: string to draw
+    :param font: FreeTypeFont used to draw the text
+    :param fill: color of the text
+    :return: n/a
+    """
+    x, y = xy
+    if img.mode == "P":
+        shades, covered, offset = palette_label(text, font, (x % 1, y % 1), fill)
+        if shades is not None:
+            # the indices of the shades replace the pixels covered by the text, without any conversion
+            img.paste(shades, (int(x) + offset[0], int(y) + offset[1]), covered)
+        return
+
+    mask, offset = label_bitmap(text, font, (x % 1, y % 1))
+    if mask is not None:
+        left, top = int(x) + offset[0], int(y) + offset[1]
+        img.paste(fill, (left, top, left + mask.width, top + mask.height), mask)
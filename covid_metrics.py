@@ -0,0 +1,50 @@
+import csv
+import json
+import time
+
+# stages timed for each region, in the order they happen, and the other measures exported for each region
+# ("predicted" is the number of seconds estimated by the scheduler of render_in_pool)
+STAGES = ["decode", "prepare", "placement", "annotations", "save"]
+MEASURES = ["status", "days", "width", "height", "pixels", "victims", "predicted"]
+
+
+def timed_iter(iterable, timings):
+    """Yields the (key, value) tuples of an iterable and records the time spent producing each one
+
+    :param iterable: iterable of (key, value) tuples, e.g. the countries parsed by iter_countries
+    :param timings: dictionary filled with the keys and the time in seconds spent producing their value
+    :return: generator of the same tuples
+    """
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            key, value = next(iterator)
+        except StopIteration:
+            return
+        timings[key] = time.perf_counter() - start
+        yield key, value
+
+
+def write_metrics(path, run_metrics, regions):
+    """Writes the measures of a run, as JSON or as CSV with one row per region depending on the extension of path
+
+    :param path: path of the report, ending with .csv for a CSV file
+    :param run_metrics: dictionary of the measures of the whole run (download time, total time...), only in JSON
+    :param regions: dictionary with the region codes as keys and dictionaries of measures as values
+    :return: n/a
+    """
+    for metrics in regions.values():
+        if "width" in metrics and "height" in metrics:
+            metrics["pixels"] = metrics["width"] * metrics["height"]
+        metrics["total"] = sum(metrics.get(stage, 0) for stage in STAGES)
+
+    if path.endswith(".csv"):
+        with open(path, "w", newline="") as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(["region"] + STAGES + ["total"] + MEASURES)
+            for region, metrics in regions.items():
+                writer.writerow([region] + [metrics.get(column, "") for column in STAGES + ["total"] + MEASURES])
+    else:
+        with open(path, "w") as json_file:
+            json.dump({"run": run_metrics, "regions": regions}, json_file, indent=1)
@@ -0,0 +1,61 @@
+from PIL import Image
+
+# the only colors of the graphs, in the order of their palette indices
+WHITE = (255, 255, 255)
+BLACK = (0, 0, 0)
+RED = (255, 0, 0)
+BLUE = (0, 0, 255)
+COLORS = [WHITE, BLACK, RED, BLUE]
+# number of intermediate shades between white and each other color, used to keep the anti-aliasing of the texts
+SHADES = 16
+
+
+def shade_index(color, level):
+    """
+    :param color: one of BLACK, RED or BLUE
+    :param level: coverage of the pixel, from 0 (white) to SHADES + 1 (the color itself)
+    :return: palette index of the color blended with white
+    """
+    if level <= 0:
+        return COLORS.index(WHITE)
+    if level > SHADES:
+        return COLORS.index(color)
+    return len(COLORS) + (COLORS.index(color) - 1) * SHADES + level - 1
+
+
+def build_palette():
+    """
+    :return: flat list of the RGB values of the palette: the colors of COLORS, then the shades of each color but white
+    """
+    palette = [value for color in COLORS for value in color]
+    for color in COLORS[1:]:
+        for level in range(1, SHADES + 1):
+            coverage = level / (SHADES + 1)
+            palette += [round(255 + (value - 255) * coverage) for value in color]
+    return palette
+
+
+PALETTE = build_palette()
+
+
+def new_canvas(size, compact=True):
+    """Creates a white image to draw a graph on
+
+    :param size: (width, height) of the image
+    :param compact: use a palette image, with one byte per pixel, instead of an RGB image with three
+    :return: Image object
+    """
+    if not compact:
+        return Image.new(mode="RGB", size=size, color=WHITE)
+    img = Image.new(mode="P", size=size, color=COLORS.index(WHITE))
+    img.putpalette(PALETTE)
+    return img
+
+
+def pixel_value(img, color):
+    """
+    :param img: Image object created by new_canvas
+    :param color: one of COLORS
+    :return: value of the pixels of this color, as returned by getpixel and expected by putpixel and paste
+    """
+    return COLORS.index(color) if img.mode == "P" else color
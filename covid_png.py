@@ -0,0 +1,176 @@
+import filecmp
+import os
+import struct
+import zlib
+
+
+def filter_rows(img):
+    """
+    :param img: Image object in "RGB" or "P" mode
+    :return: bytes of the rows of the image as stored in the PNG format, before compression
+    """
+    stride = img.width * len(img.getbands())
+    pixels = img.tobytes()
+    raw = bytearray()
+    for y in range(img.height):
+        # each row starts with its filter type, 0 means the row is stored as is
+        raw.append(0)
+        raw += pixels[y * stride:(y + 1) * stride]
+    return bytes(raw)
+
+
+class PngWriter:
+    """Writes an RGB or palette PNG image strip by strip, so the whole image never has to be held in memory
+
+    Each strip is filtered and compressed as soon as it is written, only the compressor state is kept between
+    strips.
+    """
+
+    def __init__(self, png_file, width, height, compress_level=6, palette=None):
+        """
+        :param png_file: binary file object the image is written to
+        :param width: width of the image in pixels
+        :param height: height of the image in pixels
+        :param compress_level: zlib compression level, from 0 (none) to 9 (smallest file)
+        :param palette: flat list of the RGB values of the palette for a palette image, None for an RGB image
+        """
+        self.png_file = png_file
+        self.width = width
+        self.height = height
+        self.mode = "RGB" if palette is None else "P"
+        self.rows_written = 0
+        self.compressor = zlib.compressobj(compress_level)
+        png_file.write(b"\x89PNG\r\n\x1a\n")
+        # 8 bits per channel or per index, color type 2 (RGB) or 3 (palette), default compression and filter
+        # methods, no interlacing
+        self.write_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2 if palette is None else 3, 0, 0, 0))
+        if palette is not None:
+            self.write_chunk(b"PLTE", bytes(palette))
+
+    def write_chunk(self, chunk_type, data):
+        self.png_file.write(struct.pack(">I", len(data)) + chunk_type + data
+                            + struct.pack(">I", zlib.crc32(chunk_type + data)))
+
+    def write_strip(self, img):
+        """Appends the rows of an image below the rows already written
+
+        :param img: Image object as wide as the PNG image, in "RGB" mode or in "P" mode with the palette of the PNG
+        :return: n/a
+        """
+        if img.mode != self.mode or img.width != self.width:
+            raise ValueError("The strip must be a " + self.mode + " image " + str(self.width) + " pixels wide")
+        if self.rows_written + img.height > self.height:
+            raise ValueError("The strip goes beyond the height of the image")
+
+        compressed = self.compressor.compress(filter_rows(img))
+        if compressed:
+            self.write_chunk(b"IDAT", compressed)
+        self.rows_written += img.height
+
+    def close(self):
+        """Writes the end of the image, once all its rows have been written
+
+        :return: n/a
+        """
+        if self.rows_written != self.height:
+            raise ValueError("Only " + str(self.rows_written) + " rows of " + str(self.height) + " were written")
+        self.write_chunk(b"IDAT", self.compressor.flush())
+        self.write_chunk(b"IEND", b"")
+
+
+class ApngWriter(PngWriter):
+    """Writes an animated PNG frame by frame, so the frames never have to be held in memory
+
+    The first frame covers the whole image and is also shown by the viewers that do not support animations. Each of
+    the next ones only covers the rectangle that changed since the previous frame and replaces its pixels.
+    """
+
+    def __init__(self, png_file, width, height, nb_frames, compress_level=6, palette=None, loops=1):
+        """
+        :param png_file: binary file object the image is written to
+        :param width: width of the image in pixels
+        :param height: height of the image in pixels
+        :param nb_frames: number of frames that will be written
+        :param compress_level: zlib compression level, from 0 (none) to 9 (smallest file)
+        :param palette: flat list of the RGB values of the palette for a palette image, None for an RGB image
+        :param loops: number of times the animation is played, 0 to play it forever
+        """
+        super().__init__(png_file, width, height, compress_level, palette)
+        self.compress_level = compress_level
+        self.nb_frames = nb_frames
+        self.frames_written = 0
+        self.sequence_number = 0
+        self.write_chunk(b"acTL", struct.pack(">II", nb_frames, loops))
+
+    def write_frame(self, img, left=0, top=0, delay=100):
+        """Writes a frame that replaces the pixels of a rectangle of the previous frame
+
+        :param img: Image object of the rectangle, in the mode of the animation
+        :param left: x coordinate of the rectangle, 0 for the first frame
+        :param top: y coordinate of the rectangle, 0 for the first frame
+        :param delay: number of milliseconds the frame is shown
+        :return: n/a
+        """
+        if img.mode != self.mode:
+            raise ValueError("The frame must be a " + self.mode + " image")
+        if self.frames_written == 0 and (img.size != (self.width, self.height) or left or top):
+            raise ValueError("The first frame must cover the whole image")
+        if left + img.width > self.width or top + img.height > self.height:
+            raise ValueError("The frame goes beyond the image")
+        if self.frames_written == self.nb_frames:
+            raise ValueError("All the " + str(self.nb_frames) + " frames were already written")
+
+        # dispose_op 0 (none) and blend_op 0 (source): the rectangle is replaced and the rest of the image is kept
+        self.write_chunk(b"fcTL", struct.pack(">IIIIIHHBB", self.sequence_number, img.width, img.height, left, top,
+                                              delay, 1000, 0, 0))
+        self.sequence_number += 1
+        compressed = zlib.compress(filter_rows(img), self.compress_level)
+        if self.frames_written == 0:
+            self.write_chunk(b"IDAT", compressed)
+        else:
+            self.write_chunk(b"fdAT", struct.pack(">I", self.sequence_number) + compressed)
+            self.sequence_number += 1
+        self.frames_written += 1
+
+    def close(self):
+        """Writes the end of the animation, once all its frames have been written
+
+        :return: n/a
+        """
+        if self.frames_written != self.nb_frames:
+            raise ValueError("Only " + str(self.frames_written) + " frames of " + str(self.nb_frames) + " were written")
+        self.write_chunk(b"IEND", b"")
+
+
+def write_if_changed(path, content):
+    """Writes a file unless it already has this exact content, so that unchanged files keep their modification time
+    and are not uploaded again
+
+    :param path: path of the file
+    :param content: bytes of the file
+    :return: True if the file was written, False if it was already identical
+    """
+    try:
+        if os.path.getsize(path) == len(content):
+            with open(path, "rb") as existing_file:
+                if existing_file.read() == content:
+                    return False
+    except FileNotFoundError:
+        pass
+    with open(path, "wb") as output_file:
+        output_file.write(content)
+    return True
+
+
+def replace_if_changed(new_path, path):
+    """Moves a file just written over path, unless path already has the same content
+
+    :param new_path: path of the new file, removed in both cases
+    :param path: path of the final file
+    :return: True if path was replaced, False if it was already identical
+    """
+    if os.path.exists(path) and filecmp.cmp(new_path, path, shallow=False):
+        os.remove(new_path)
+        return False
+    os.replace(new_path, path)
+    return True
@@ -0,0 +1,20 @@
+import fnmatch
+
+
+def is_glob(pattern):
+    """
+    :param pattern: region code or glob pattern
+    :return: True if the pattern has wildcards, see match_regions
+    """
+    return any(character in pattern for character in "*?[")
+
+
+def match_regions(codes, patterns):
+    """Selects the region codes that match codes or glob patterns, whatever their case
+
+    :param codes: iterable of region codes
+    :param patterns: list of region codes or glob patterns, e.g. ["FRA", "OWID_*"]
+    :return: list of the matching codes, in the order of codes
+    """
+    patterns = [pattern.upper() for pattern in patterns]
+    return [code for code in codes if any(fnmatch.fnmatchcase(code.upper(), pattern) for pattern in patterns)]
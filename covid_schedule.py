@@ -0,0 +1,102 @@
+import collections
+
+# seconds per victim placed, per pixel drawn and encoded, per day of the series and per region, fitted on the
+# synthetic datasets of covid_deaths_graph_bench.py. Only their ratios matter to the order of the regions: the report
+# of each batch shows how far the predictions are from the times measured on the current machine
+SECONDS_PER_VICTIM = 3.1e-7
+SECONDS_PER_PIXEL = 1.5e-8
+SECONDS_PER_DAY = 3.2e-5
+SECONDS_PER_REGION = 1.0e-3
+
+
+def predict_cost(victims, pixels, days):
+    """Predicts the time needed to render a region from the size of its work
+
+    :param victims: number of victims placed
+    :param pixels: number of pixels drawn and encoded
+    :param days: number of days of the series, parsed and annotated
+    :return: number of seconds
+    """
+    return (SECONDS_PER_REGION + victims * SECONDS_PER_VICTIM + pixels * SECONDS_PER_PIXEL
+            + days * SECONDS_PER_DAY)
+
+
+class CostScheduler:
+    """Hands out the tasks of a batch the most costly first, within a number of slots and a memory budget
+
+    The order is kept even when memory is short: the next task waits for running ones to finish instead of being
+    overtaken by smaller ones, which would leave the largest tasks to the end of the batch. A task that needs more than
+    the whole budget runs alone.
+    """
+
+    def __init__(self, estimates, slots, memory_budget=None):
+        """
+        :param estimates: dictionary with the task keys as keys and (seconds, bytes) tuples as values
+        :param slots: number of tasks run at the same time
+        :param memory_budget: total number of bytes of the tasks run at the same time, None for no limit
+        """
+        self.estimates = estimates
+        self.slots = slots
+        self.memory_budget = memory_budget
+        # sorted() is stable, so tasks of the same cost keep their order
+        self.waiting = collections.deque(sorted(estimates, key=lambda key: estimates[key][0], reverse=True))
+        self.running = {}
+        self.memory = 0
+        self.order = []
+
+    def __len__(self):
+        return len(self.waiting)
+
+    def start(self):
+        """Takes the tasks that can start now, given the slots and the memory left by the running ones
+
+        :return: list of the task keys to start, in order
+        """
+        started = []
+        while self.waiting and len(self.running) < self.slots:
+            memory = self.estimates[self.waiting[0]][1]
+            if self.running and self.memory_budget is not None and self.memory + memory > self.memory_budget:
+                break
+            key = self.waiting.popleft()
+            self.running[key] = memory
+            self.memory += memory
+            started.append(key)
+        self.order.extend(started)
+        return started
+
+    def finish(self, key):
+        """Releases the slot and the memory of a task
+
+        :param key: key of a task returned by start
+        :return: n/a
+        """
+        self.memory -= self.running.pop(key)
+
+
+def print_cost_report(estimates, times, order=None, top=5):
+    """Prints the predicted and measured costs of a batch, and the regions the model got most wrong
+
+    :param estimates: dictionary with the region codes as keys and (seconds, bytes) tuples as values
+    :param times: dictionary with the region codes as keys and the measured number of seconds (None if unknown) as
+    values
+    :param order: list of the region codes in the order they were started, see CostScheduler
+    :param top: number of regions listed
+    :return: n/a
+    """
+    order = order or []
+    measured = {key: seconds for key, seconds in times.items() if seconds is not None and key in estimates}
+    if not measured:
+        return
+    predicted_total = sum(estimates[key][0] for key in measured)
+    measured_total = sum(measured.values())
+    print("Cost model : " + "%.1f" % predicted_total + " s predicted, " + "%.1f" % measured_total + " s measured for "
+          + str(len(measured)) + " regions")
+    # the rates depend on the machine, so each prediction is compared once scaled by the ratio of the totals
+    factor = measured_total / predicted_total if predicted_total else 1
+    slowest = max(measured, key=measured.get)
+    position = " (started " + str(order.index(slowest) + 1) + "/" + str(len(order)) + ")" if slowest in order else ""
+    print("Slowest region : " + slowest + ", " + "%.2f" % measured[slowest] + " s" + position)
+    worst = sorted(measured, key=lambda key: abs(measured[key] - factor * estimates[key][0]), reverse=True)[:top]
+    for key in worst:
+        print("  " + key + " : " + "%.2f" % (factor * estimates[key][0]) + " s predicted, "
+              + "%.2f" % measured[key] + " s measured")
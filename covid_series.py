@@ -0,0 +1,82 @@
+from array import array
+import datetime
+import hashlib
+
+
+class DaySeries:
+    """Daily death series of a region, stored as typed arrays of the same length
+
+    Dates are stored as proleptic Gregorian ordinals. The moving averages are usually calculated once all the days
+    are appended, for many series at once, see covid_smoothing.smooth_batch.
+    """
+    __slots__ = ("dates", "daily_deaths", "total_deaths", "moving_average", "window", "smoothing")
+
+    def __init__(self, window=7):
+        """
+        :param window: number of days of the moving average
+        """
+        self.dates = array("l")
+        self.daily_deaths = array("d")
+        self.total_deaths = array("d")
+        self.moving_average = array("d")
+        self.window = window
+        # smoothing mode of the moving averages, see covid_smoothing.MODES, None if they are the daily deaths
+        self.smoothing = None
+
+    def __len__(self):
+        return len(self.dates)
+
+    def append(self, date, daily_deaths, total_deaths, moving_average=0):
+        """Adds a day at the end of the series
+
+        :param date: date with format yyyy-mm-dd
+        :param daily_deaths: number of deaths of the day
+        :param total_deaths: total number of deaths at this date
+        :param moving_average: number of victims drawn for this day, if it is not calculated later
+        :return: n/a
+        """
+        self.dates.append(datetime.date.fromisoformat(date).toordinal())
+        self.daily_deaths.append(daily_deaths)
+        self.total_deaths.append(total_deaths)
+        self.moving_average.append(moving_average)
+
+    def date(self, index):
+        """
+        :param index: index of the day in the series, negative values count from the end
+        :return: date of the day with format yyyy-mm-dd
+        """
+        return datetime.date.fromordinal(self.dates[index]).isoformat()
+
+    def year(self, index):
+        """
+        :param index: index of the day in the series, negative values count from the end
+        :return: year of the day
+        """
+        return datetime.date.fromordinal(self.dates[index]).year
+
+
+def region_seed(region, data):
+    """Derives the seed of the random placement of the victims of a region from its code and its series
+
+    :param region: code of the country or region
+    :param data: DaySeries that contains all data, formatted and ready to be used to draw the image output
+    :return: 64-bit integer, the same for the same region and data in any process
+    """
+    seed_hash = hashlib.sha256(region.encode("utf-8"))
+    for column in (data.dates, data.daily_deaths, data.total_deaths, data.moving_average):
+        seed_hash.update(column.tobytes())
+    return int.from_bytes(seed_hash.digest()[:8], "little")
+
+
+def first_day_seed(region, first_date):
+    """Derives the seed of the random placement of the victims of a region from its code and its first date only
+
+    Unlike region_seed, the seed does not change as days are appended, so a series drawn once and extended day by day
+    gets the same seed as when it is drawn at once, see covid_deaths_graph_fra.extend_image.
+
+    :param region: code of the country or region
+    :param first_date: date of the first day of the series with format yyyy-mm-dd
+    :return: 64-bit integer, the same for the same region and first date in any process
+    """
+    seed_hash = hashlib.sha256((region + "\0" + first_date).encode("utf-8"))
+    return int.from_bytes(seed_hash.digest()[:8], "little")
@@ -0,0 +1,136 @@
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    # numpy is optional: without it, each series is smoothed on its own with pure Python loops
+    np = None
+
+# "trailing": mean of the `window` days before each day, the first `window` days are not smoothed
+# "centered": mean of the days from window // 2 days before to window // 2 days after each day, fewer at the edges
+# "exponential": exponential moving average with a smoothing factor of 2 / (window + 1)
+MODES = ("trailing", "centered", "exponential")
+
+
+def smooth_batch(series_list, window=7, mode="trailing", threshold=5000):
+    """Calculates the moving averages of several series at once, in a single (regions x days) numpy array
+
+    The values are truncated to integers, like the averages drawn by the original loop. The days of each window are
+    added one at a time and in the same order as that loop, rather than taken from a difference of cumulative sums,
+    so that the averages are identical to it to the last bit even when the daily deaths are not whole numbers.
+
+    :param series_list: list of DaySeries, their moving_average, window and smoothing attributes are replaced
+    :param window: number of days of the moving average, see MODES
+    :param mode: one of MODES
+    :param threshold: series with fewer total deaths on their last day are not smoothed, None to smooth every series
+    :return: n/a
+    """
+    if mode not in MODES:
+        raise ValueError("Unknown smoothing mode " + str(mode) + ", expected one of " + ", ".join(MODES))
+    smoothed = [series for series in series_list
+                if len(series) and (threshold is None or series.total_deaths[-1] > threshold)]
+    for series in series_list:
+        series.window = window
+        series.smoothing = None
+        series.moving_average = array("d", series.daily_deaths)
+    if not smoothed:
+        return
+    if np is None:
+        for series in smoothed:
+            smooth_python(series, window, mode)
+        return
+
+    lengths = np.array([len(series) for series in smoothed])
+    nb_days = int(lengths.max())
+    daily = np.zeros((len(smoothed), nb_days))
+    for row, series in enumerate(smoothed):
+        daily[row, :len(series)] = np.frombuffer(series.daily_deaths, dtype=np.float64)
+    if mode == "trailing":
+        averages = daily.copy()
+        if nb_days > window:
+            # one shifted slice per day of the window, each day being the sum of the `window` days before it
+            sums = np.zeros((len(smoothed), nb_days - window))
+            for shift in range(window):
+                sums += daily[:, shift:nb_days - window + shift]
+            averages[:, window:] = sums / window
+    elif mode == "centered":
+        half = window // 2
+        # zeros around the days, adding them leaves the sums unchanged, and they must not be counted
+        padded = np.zeros((len(smoothed), nb_days + 2 * half))
+        padded[:, half:half + nb_days] = daily
+        sums = np.zeros_like(daily)
+        for shift in range(2 * half + 1):
+            sums += padded[:, shift:shift + nb_days]
+        days = np.arange(nb_days)
+        first = np.clip(days - half, 0, None)
+        # the days after the end of each series are zeros that must not be counted either
+        last = np.minimum(days + half + 1, lengths[:, None])
+        counts = np.maximum(last - first, 1)
+        averages = sums / counts
+    else:
+        alpha = 2 / (window + 1)
+        averages = np.empty_like(daily)
+        averages[:, 0] = daily[:, 0]
+        for day in range(1, nb_days):
+            averages[:, day] = alpha * daily[:, day] + (1 - alpha) * averages[:, day - 1]
+
+    # adding 0.0 turns the -0.0 left by trunc into 0.0, as int() does
+    averages = np.trunc(averages) + 0.0
+    if mode == "trailing":
+        # the first days have no full window and are drawn as they are, without truncation
+        averages[:, :window] = daily[:, :window]
+    for row, series in enumerate(smoothed):
+        series.moving_average = array("d", averages[row, :len(series)].tobytes())
+        series.smoothing = mode
+
+
+def smooth_python(series, window, mode):
+    """Same as smooth_batch for a single series, without numpy
+
+    :param series: DaySeries whose moving_average and smoothing attributes are replaced
+    :param window: number of days of the moving average
+    :param mode: one of MODES
+    :return: n/a
+    """
+    daily = series.daily_deaths
+    if mode == "trailing":
+        averages = [daily[day] if day < window else int(add_days(daily[day - window:day]) / window)
+                    for day in range(len(daily))]
+    elif mode == "centered":
+        averages = []
+        for day in range(len(daily)):
+            days = daily[max(0, day - window // 2):day + window // 2 + 1]
+            averages.append(int(add_days(days) / len(days)))
+    else:
+        averages = [int(average) for average in exponential_averages(daily, window)]
+    series.moving_average = array("d", averages)
+    series.smoothing = mode
+
+
+def add_days(days):
+    """Adds daily deaths one at a time, in order, like the original loop (sum() may round differently)
+
+    :param days: sequence of daily deaths
+    :return: sum of the days
+    """
+    total = 0
+    for daily_deaths in days:
+        total += daily_deaths
+    return total
+
+
+def exponential_averages(daily_deaths, window, average=None):
+    """Calculates the exponential moving averages of smooth_batch before their truncation, to carry them on later
+
+    :param daily_deaths: sequence of daily deaths
+    :param window: number of days of the moving average
+    :param average: untruncated average of the day before the first day, None if the series starts with it
+    :return: list of the untruncated averages, one per day
+    """
+    alpha = 2 / (window + 1)
+    averages = []
+    for daily in daily_deaths:
+        # same operations as the numpy loop of smooth_batch, so that the results are identical to the last bit
+        average = daily if average is None else alpha * daily + (1 - alpha) * average
+        averages.append(average)
+    return averages
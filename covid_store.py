@@ -0,0 +1,191 @@
+from array import array
+import datetime
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+
+# first bytes of the file, the last one is the version of the format
+MAGIC = b"COVIDST1"
+
+
+def pad(length):
+    """
+    :param length: number of bytes
+    :return: number of bytes to add to reach the next multiple of 8
+    """
+    return -length % 8
+
+
+def source_stamp(source_path):
+    """
+    :param source_path: path of a data file
+    :return: dictionary that identifies the file, different once it is replaced or modified
+    """
+    stat = os.stat(source_path)
+    return {"path": os.path.abspath(source_path), "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+def store_is_fresh(store_path, source_path):
+    """
+    :param store_path: path of the columnar store
+    :param source_path: path of the data file
+    :return: True if the store exists, is of the version read by ColumnStore and was converted from this very file,
+    unchanged since then, see write_store
+    """
+    if not os.path.exists(store_path):
+        return False
+    with open(store_path, "rb") as store_file:
+        if store_file.read(len(MAGIC)) != MAGIC:
+            return False
+        try:
+            index_length, = struct.unpack("<Q", store_file.read(8))
+            index = json.loads(store_file.read(index_length).decode("utf-8"))
+        except (struct.error, ValueError):
+            # a store cut short
+            return False
+    return index.get("source") == source_stamp(source_path)
+
+
+def write_store(store_path, countries, source_path=None):
+    """Converts parsed countries into a columnar store that can be read one region at a time, see ColumnStore
+
+    The file holds a JSON index with the location and the first day and number of days of each region, then three
+    contiguous columns for the days of all the regions: the dates as ordinals (int32), the new deaths and the total
+    deaths (float64, NaN when the value is missing). It replaces the previous store only once fully written.
+
+    A region that cannot be converted (no location, invalid date or number) is kept as it is in the index instead,
+    so that it still fails on its own when it is rendered, as when it is read from the data file.
+
+    :param store_path: path of the columnar store
+    :param countries: iterable of (region code, trimmed country dictionary) tuples, see trim_country
+    :param source_path: path of the data file the countries are parsed from, recorded in the index so that the store
+    is only read again for the same file, see store_is_fresh. None if they do not come from a file
+    :return: number of regions converted to columns
+    """
+    # taken before the file is read, a file modified during the conversion is then converted again by the next run
+    source = source_stamp(source_path) if source_path else None
+    regions = []
+    unconverted = {}
+    dates = array("i")
+    new_deaths = array("d")
+    total_deaths = array("d")
+    for region, country in countries:
+        # the days of the region are converted apart first, so that an invalid one leaves the columns untouched
+        region_dates = array("i")
+        region_new_deaths = array("d")
+        region_total_deaths = array("d")
+        try:
+            location = country["location"]
+            for day in country["data"]:
+                region_dates.append(datetime.date.fromisoformat(day["date"]).toordinal())
+                region_new_deaths.append(day.get("new_deaths", math.nan))
+                region_total_deaths.append(day.get("total_deaths", math.nan))
+        except (KeyError, TypeError, ValueError, AttributeError, OverflowError):
+            regions.append([region, None, 0, 0])
+            unconverted[region] = country
+            continue
+        regions.append([region, location, len(dates), len(region_dates)])
+        dates.extend(region_dates)
+        new_deaths.extend(region_new_deaths)
+        total_deaths.extend(region_total_deaths)
+
+    # the columns are stored little-endian whatever the machine
+    if sys.byteorder == "big":
+        for column in (dates, new_deaths, total_deaths):
+            column.byteswap()
+
+    index = json.dumps({"regions": regions, "days": len(dates), "unconverted": unconverted,
+                        "source": source}).encode("utf-8")
+    with open(store_path + ".tmp", "wb") as store_file:
+        store_file.write(MAGIC + struct.pack("<Q", len(index)) + index + b"\0" * pad(len(index)))
+        for column in (dates, new_deaths, total_deaths):
+            store_file.write(column.tobytes())
+            store_file.write(b"\0" * pad(len(column) * column.itemsize))
+    os.replace(store_path + ".tmp", store_path)
+    return len(regions) - len(unconverted)
+
+
+class ColumnStore:
+    """Columnar store written by write_store, mapped in memory so that only the pages of the regions read are loaded"""
+
+    def __init__(self, store_path):
+        """
+        :param store_path: path of the columnar store
+        """
+        with open(store_path, "rb") as store_file:
+            self.map = mmap.mmap(store_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.map.close()
+            raise ValueError(store_path + " is not a columnar store of this version")
+        index_length, = struct.unpack_from("<Q", self.map, len(MAGIC))
+        index_start = len(MAGIC) + 8
+        index = json.loads(self.map[index_start:index_start + index_length].decode("utf-8"))
+        self.regions = {region: (location, start, count) for region, location, start, count in index["regions"]}
+        self.unconverted = index.get("unconverted", {})
+
+        nb_days = index["days"]
+        dates_start = index_start + index_length + pad(index_length)
+        new_deaths_start = dates_start + 4 * nb_days + pad(4 * nb_days)
+        total_deaths_start = new_deaths_start + 8 * nb_days
+        self.view = memoryview(self.map)
+        self.dates = self.column(dates_start, 4 * nb_days, "i")
+        self.new_deaths = self.column(new_deaths_start, 8 * nb_days, "d")
+        self.total_deaths = self.column(total_deaths_start, 8 * nb_days, "d")
+
+    def column(self, start, length, type_code):
+        # a view of the mapped file, without any copy, unless the machine is big-endian
+        column = self.view[start:start + length].cast(type_code)
+        if sys.byteorder == "big":
+            column = array(type_code, column)
+            column.byteswap()
+        return column
+
+    def __contains__(self, region):
+        return region in self.regions
+
+    def __len__(self):
+        return len(self.regions)
+
+    def country(self, region):
+        """Reads the days of a region only
+
+        :param region: region code
+        :return: trimmed country dictionary, the same as the one the data file was converted from, see trim_country
+        """
+        if region in self.unconverted:
+            return self.unconverted[region]
+        location, start, count = self.regions[region]
+        data = []
+        for date, new_deaths, total_deaths in zip(self.dates[start:start + count],
+                                                  self.new_deaths[start:start + count],
+                                                  self.total_deaths[start:start + count]):
+            day = {"date": datetime.date.fromordinal(date).isoformat()}
+            if not math.isnan(new_deaths):
+                day["new_deaths"] = new_deaths
+            if not math.isnan(total_deaths):
+                day["total_deaths"] = total_deaths
+            data.append(day)
+        return {"location": location, "data": data}
+
+    def iter_countries(self):
+        """
+        :return: generator of (region code, trimmed country dictionary) tuples, in the order of the data file
+        """
+        for region in self.regions:
+            yield region, self.country(region)
+
+    def close(self):
+        for column in (self.dates, self.new_deaths, self.total_deaths):
+            if isinstance(column, memoryview):
+                column.release()
+        self.view.release()
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,63 @@
+import math
+import random
+from covid_palette import BLACK, WHITE, pixel_value
+
+
+def band_capacity(plot_width, line_multiplier):
+    """Calculates the number of victims that always fit in the band of a day
+
+    A band covers line_multiplier + 1 rows and shares its first row with the band of the previous day, which may
+    already be full, so only line_multiplier rows are guaranteed to be free.
+
+    :param plot_width: width in pixels of the area where victims are drawn
+    :param line_multiplier: height in pixels of each day
+    :return: number of free pixels of a band in the worst case
+    """
+    return plot_width * line_multiplier
+
+
+def victim_scale(max_moving_average, capacity):
+    """Calculates how many victims each black pixel stands for so that every day fits in its band
+
+    :param max_moving_average: highest number of victims drawn for a day
+    :param capacity: number of victims that always fit in a band, see band_capacity
+    :return: number of victims per pixel, 1 unless a day exceeds the capacity of its band
+    """
+    return max(1, math.ceil(max_moving_average / capacity))
+
+
+def place_band_victims(img, left, top, width, height, nb_victims, rng=random):
+    """Places victims at random free pixels of a band of the image, pixel by pixel
+
+    Random pixels are tried first. Once too many tries have hit pixels already taken, the remaining victims are drawn
+    from the list of the free pixels of the band, so the cost stays bounded even when the band is almost full.
+
+    :param img: Image object the victims are drawn on, see new_canvas
+    :param left: x coordinate of the left of the band
+    :param top: y coordinate of the top of the band
+    :param width: width of the band in pixels
+    :param height: height of the band in pixels
+    :param nb_victims: number of victims to place
+    :param rng: random.Random object the pixels are picked with, the random module itself by default
+    :return: number of victims placed, lower than nb_victims only if the band is full
+    """
+    white = pixel_value(img, WHITE)
+    black = pixel_value(img, BLACK)
+    placed = 0
+    tries = 0
+    while placed < nb_victims and tries < 2 * nb_victims + 10:
+        tries += 1
+        pixel = (rng.randint(left, left + width - 1), rng.randint(top, top + height - 1))
+        # check if the pixel is already "dead" to avoid the superposition of victims
+        if img.getpixel(pixel) == white:
+            img.putpixel(pixel, black)
+            placed += 1
+
+    if placed < nb_victims:
+        free_pixels = [(x, y) for y in range(top, top + height) for x in range(left, left + width)
+                       if img.getpixel((x, y)) == white]
+        for pixel in rng.sample(free_pixels, min(nb_victims - placed, len(free_pixels))):
+            img.putpixel(pixel, black)
+            placed += 1
+
+    return placed
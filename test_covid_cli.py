@@ -0,0 +1,27 @@
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+from covid_cli import main
+
+DATA = {"FRA": {"location": "France", "data": [{"date": "2020-03-01", "new_deaths": 2.0, "total_deaths": 2.0}]},
+        "BAD": {"location": "Bad date", "data": [{"date": "2020-02-30", "new_deaths": 1.0}]}}
+
+
+class ListTest(unittest.TestCase):
+
+    def test_list_with_an_invalid_region(self):
+        with tempfile.TemporaryDirectory() as directory:
+            data_path = os.path.join(directory, "data.json")
+            with open(data_path, "w") as data_file:
+                json.dump(DATA, data_file)
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                main(["list", "--offline", data_path, "--store", os.path.join(directory, "data.store")])
+        self.assertEqual(output.getvalue().splitlines(), ["FRA\tFrance\t1", "BAD\t(invalid data)"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,25 @@
+import io
+import json
+import unittest
+from covid_deaths_graph import iter_countries
+
+DAYS = [{"date": "2020-03-01", "new_cases": 5.0, "new_deaths": 2.0, "total_deaths": 2.0}]
+
+
+class ParserTest(unittest.TestCase):
+
+    def test_invalid_countries_are_yielded_as_they_are(self):
+        data = {"FRA": {"location": "France", "continent": "Europe", "data": DAYS},
+                "NOL": {"continent": "Europe", "data": DAYS},
+                "NOD": {"location": "No data"},
+                "ITA": {"location": "Italy", "data": DAYS}}
+        countries = list(iter_countries(io.StringIO(json.dumps(data)), chunk_size=16))
+        self.assertEqual([code for code, _ in countries], ["FRA", "NOL", "NOD", "ITA"])
+        self.assertEqual(countries[0][1], {"location": "France", "data": [
+            {"date": "2020-03-01", "new_deaths": 2.0, "total_deaths": 2.0}]})
+        self.assertEqual(countries[1][1], data["NOL"])
+        self.assertEqual(countries[2][1], data["NOD"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+from PIL import ImageFont
+import covid_deaths_graph_fra as graph_fra
+from covid_deaths_graph_bench import synthetic_fra
+
+FONT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "asap.ttf")
+
+
+def asap_fonts():
+    # arial.ttf is not shipped with the repository
+    return ImageFont.truetype(FONT_PATH, size=10), ImageFont.truetype(FONT_PATH, size=8)
+
+
+class ExtensionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.previous_directory = os.getcwd()
+        os.chdir(self.directory.name)
+        self.load_fonts = graph_fra.load_fonts
+        graph_fra.load_fonts = asap_fonts
+
+    def tearDown(self):
+        graph_fra.load_fonts = self.load_fonts
+        os.chdir(self.previous_directory)
+        self.directory.cleanup()
+
+    def render(self, days):
+        """Runs the script on the first days of the dataset
+
+        :return: tuple (status of the run, bytes of covid.png)
+        """
+        with open("data.json", "w") as data_file:
+            json.dump(days, data_file)
+        with contextlib.redirect_stdout(io.StringIO()):
+            graph_fra.main(offline="data.json")
+        with open("covid_metrics_fra.json") as metrics_file:
+            status = json.load(metrics_file)["regions"]["FRA"]["status"]
+        with open(graph_fra.IMAGE_PATH, "rb") as image_file:
+            return status, image_file.read()
+
+    def test_extended_image_is_a_fresh_render(self):
+        days = synthetic_fra(700, 1000)
+        self.render(days[:650])
+        for nb_days in (651, 652, 660, 700):
+            status, extended = self.render(days[:nb_days])
+            self.assertEqual(status, "extended")
+            os.remove("covid_fra_state.json")
+            status, fresh = self.render(days[:nb_days])
+            self.assertEqual(status, "exported")
+            self.assertEqual(extended, fresh, str(nb_days) + " days")
+
+
+if __name__ == '__main__':
+    unittest.main()
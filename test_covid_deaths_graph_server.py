@@ -0,0 +1,43 @@
+import io
+import json
+import threading
+import unittest
+import urllib.request
+from http.server import ThreadingHTTPServer
+from covid_deaths_graph_server import PngCache, RenderService, RequestHandler, load_regions
+
+DATA = {"FRA": {"location": "France",
+                "data": [{"date": "2020-03-%02d" % day, "new_deaths": 10.0, "total_deaths": 10.0 * day}
+                         for day in range(1, 31)]}}
+
+
+class ReloadedService(RenderService):
+    """Service whose data is reloaded without the region between the lookup of the handler and the rendering"""
+
+    def image(self, region, entry=None):
+        self.regions = {}
+        return super().image(region, entry)
+
+
+class ServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.service = ReloadedService(PngCache(1 << 20))
+        self.service.regions = load_regions(io.BytesIO(json.dumps(DATA).encode("utf-8")))
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), RequestHandler)
+        self.server.service = self.service
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_region_removed_by_a_reload_during_the_request(self):
+        url = "http://127.0.0.1:" + str(self.server.server_port) + "/covid_fra.png"
+        with urllib.request.urlopen(url) as response:
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.read()[:8], b"\x89PNG\r\n\x1a\n")
+
+
+if __name__ == '__main__':
+    unittest.main()
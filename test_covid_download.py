@@ -0,0 +1,117 @@
+import asyncio
+import http.client
+import io
+import os
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError, URLError
+from covid_download import download, fetch, open_snapshot, update_cache
+
+BODY = b'{"FRA": {"location": "France", "data": []}}'
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Stand-in for the data servers, with one path per kind of failure"""
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        count = sum(1 for path, _ in self.server.requests if path == self.path)
+        if self.path == "/flaky" and count == 1:
+            self.send_error(503)
+        elif self.path == "/missing":
+            self.send_error(404)
+        elif self.path == "/etag" and self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+        elif self.path == "/trickle":
+            self.send_response(200)
+            self.send_header("Content-Length", "20")
+            self.end_headers()
+            try:
+                for _ in range(20):
+                    self.wfile.write(b"x")
+                    self.wfile.flush()
+                    time.sleep(0.2)
+            except OSError:
+                # the client gave up
+                pass
+        elif self.path == "/truncated":
+            self.send_response(200)
+            self.send_header("Content-Length", "100")
+            self.end_headers()
+            self.wfile.write(b"x" * 50)
+        else:
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(BODY)))
+            self.send_header("ETag", '"v1"')
+            self.end_headers()
+            self.wfile.write(BODY)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+        self.server.daemon_threads = True
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def url(self, path):
+        return "http://127.0.0.1:" + str(self.server.server_port) + path
+
+    def count(self, path):
+        return sum(1 for request_path, _ in self.server.requests if request_path == path)
+
+    def test_retry_after_503(self):
+        target = io.BytesIO()
+        asyncio.run(fetch(self.url("/flaky"), target, retries=2, backoff=0))
+        self.assertEqual(target.getvalue(), BODY)
+        self.assertEqual(self.count("/flaky"), 2)
+
+    def test_no_retry_after_404(self):
+        with self.assertRaises(HTTPError) as context:
+            asyncio.run(fetch(self.url("/missing"), io.BytesIO(), retries=3, backoff=0))
+        self.assertEqual(context.exception.code, 404)
+        self.assertEqual(self.count("/missing"), 1)
+
+    def test_304_reuses_the_copy(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache_path = os.path.join(directory, "data.json.gz")
+            self.assertTrue(asyncio.run(update_cache(self.url("/etag"), cache_path, retries=0)))
+            self.assertFalse(asyncio.run(update_cache(self.url("/etag"), cache_path, retries=0)))
+            self.assertEqual(self.server.requests[-1][1].get("If-None-Match"), '"v1"')
+            with open_snapshot(cache_path) as snapshot:
+                self.assertEqual(snapshot.read(), BODY)
+            self.assertFalse(os.path.exists(cache_path + ".tmp"))
+
+    def test_max_time_on_trickle(self):
+        start = time.monotonic()
+        with self.assertRaises(URLError) as context:
+            download(self.url("/trickle"), io.BytesIO(), timeout=5, max_time=0.5)
+        self.assertIsInstance(context.exception.reason, TimeoutError)
+        # the whole response would take 4 s
+        self.assertLess(time.monotonic() - start, 2)
+
+    def test_truncated_response(self):
+        with self.assertRaises(URLError) as context:
+            download(self.url("/truncated"), io.BytesIO(), timeout=5)
+        self.assertIsInstance(context.exception.reason, http.client.IncompleteRead)
+
+    def test_truncated_response_is_retried(self):
+        with self.assertRaises(URLError):
+            asyncio.run(fetch(self.url("/truncated"), io.BytesIO(), timeout=5, retries=1, backoff=0))
+        self.assertEqual(self.count("/truncated"), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import datetime
+import random
+import unittest
+from covid_series import DaySeries
+import covid_smoothing
+from covid_smoothing import MODES, smooth_batch, smooth_python
+
+
+def random_series(rng, nb_days, fractional):
+    series = DaySeries()
+    total_deaths = 0
+    for day in range(nb_days):
+        daily_deaths = round(rng.uniform(-5, 900), rng.choice([1, 2, 3])) if fractional else rng.randint(0, 900)
+        total_deaths += daily_deaths
+        series.append((datetime.date(2020, 3, 1) + datetime.timedelta(days=day)).isoformat(), daily_deaths,
+                      total_deaths)
+    return series
+
+
+@unittest.skipIf(covid_smoothing.np is None, "numpy is not installed")
+class SmoothingTest(unittest.TestCase):
+
+    def assertSameAverages(self, series_list, window, mode):
+        smooth_batch(series_list, window, mode, threshold=None)
+        batch = [series.moving_average.tobytes() for series in series_list]
+        for series, averages in zip(series_list, batch):
+            smooth_python(series, window, mode)
+            self.assertEqual(series.moving_average.tobytes(), averages, mode + ", window " + str(window))
+
+    def test_numpy_and_fallback_are_identical(self):
+        rng = random.Random(1)
+        for mode in MODES:
+            for window in range(1, 15):
+                for fractional in (False, True):
+                    self.assertSameAverages([random_series(rng, rng.randint(1, 120), fractional) for _ in range(10)],
+                                            window, mode)
+
+    def test_exponential_first_day(self):
+        series = DaySeries()
+        series.append("2020-03-01", 7, 7)
+        series.append("2020-03-02", 7, 14)
+        self.assertSameAverages([series], 10, "exponential")
+        self.assertEqual(list(series.moving_average), [7.0, 6.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
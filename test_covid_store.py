@@ -0,0 +1,58 @@
+import os
+import tempfile
+import unittest
+from covid_store import ColumnStore, store_is_fresh, write_store
+
+COUNTRIES = [("FRA", {"location": "France", "data": [{"date": "2020-03-01", "new_deaths": 2.0, "total_deaths": 2.0},
+                                                     {"date": "2020-03-02", "total_deaths": 2.0}]}),
+             ("BAD", {"location": "Bad date", "data": [{"date": "2020-02-30", "new_deaths": 1.0}]})]
+
+
+class StoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store_path = self.path("data.store")
+        self.source_path = self.path("data.json")
+        with open(self.source_path, "w") as source_file:
+            source_file.write("{}")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def test_fresh_for_its_source_only(self):
+        self.assertFalse(store_is_fresh(self.store_path, self.source_path))
+        write_store(self.store_path, COUNTRIES, self.source_path)
+        self.assertTrue(store_is_fresh(self.store_path, self.source_path))
+        # another file, even older than the store, was not converted into it
+        other_path = self.path("other.json")
+        with open(other_path, "w") as other_file:
+            other_file.write("{}")
+        os.utime(other_path, (0, 0))
+        self.assertFalse(store_is_fresh(self.store_path, other_path))
+
+    def test_not_fresh_once_the_source_changes(self):
+        write_store(self.store_path, COUNTRIES, self.source_path)
+        with open(self.source_path, "w") as source_file:
+            source_file.write('{"FRA": {}}')
+        self.assertFalse(store_is_fresh(self.store_path, self.source_path))
+
+    def test_not_fresh_for_another_version(self):
+        write_store(self.store_path, COUNTRIES, self.source_path)
+        with open(self.store_path, "r+b") as store_file:
+            store_file.write(b"COVIDST0")
+        self.assertFalse(store_is_fresh(self.store_path, self.source_path))
+
+    def test_unconverted_region_kept_as_is(self):
+        self.assertEqual(write_store(self.store_path, COUNTRIES, self.source_path), 1)
+        with ColumnStore(self.store_path) as store:
+            self.assertEqual(list(store.regions), ["FRA", "BAD"])
+            self.assertEqual(store.country("FRA"), COUNTRIES[0][1])
+            self.assertEqual(store.country("BAD"), COUNTRIES[1][1])
+
+
+if __name__ == '__main__':
+    unittest.main()